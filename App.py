@@ -1,418 +1,633 @@
-from pywebio import start_server
-from pywebio import config
+from pywebio.platform.tornado import webio_handler
+from pywebio.utils import STATIC_PATH
 from pywebio.input import select, input, checkbox, TEXT, SELECT
-from pywebio.output import put_text, put_buttons, put_markdown, put_error, use_scope, put_html, put_image
-from pywebio.session import hold
-from openpyxl import Workbook, load_workbook
+from pywebio.output import put_text, put_buttons, put_markdown, put_error, use_scope, put_html, put_image, put_table, put_scope
+from pywebio.session import hold, eval_js, run_js, defer_call, Session
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.process
+import tornado.web
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import hashlib
+import html
+import inspect
 import os
-import random
-
+import signal
+import sys
+import threading
+import time
+import weakref
+from quiz_engine import (QuizEngine, metrics, category_error_rates, most_missed, compact_journal, share_data_files,
+                         describe_mistake, flush_progress)
+from quiz_search import search_quizzes
+
+
+RECAP_PAGE_SIZE = 20  # gruppi di errori mostrati per pagina nel riepilogo
+EDIT_PAGE_SIZE = 50  # risultati della ricerca mostrati per pagina nell'editor dei quiz
+PROFILER_INTERVAL = 0.005  # secondi tra due campioni del profiler di sessione
+SESSION_SAVE_INTERVAL = 5.0  # secondi minimi tra due salvataggi dello stato di sessione durante il quiz
+PREFETCH_WORKERS = 4  # thread condivisi da tutte le sessioni per preparare le domande successive
+IO_WORKERS = 4  # thread che eseguono file e SQLite per le sessioni a coroutine, senza bloccare il loop di Tornado
+BUSY_RETRY_AFTER = 10  # secondi dopo i quali un client respinto perché il processo è al completo riprova
+REAPER_INTERVAL = 30.0  # secondi massimi tra due controlli delle sessioni inattive
+USER_ID_JS = """(function () {
+    var id = localStorage.getItem('kanji_quiz_user');
+    if (!id) {
+        id = Date.now().toString(36) + Math.random().toString(36).slice(2);
+        localStorage.setItem('kanji_quiz_user', id);
+    }
+    return id;
+})()"""
+
+# Risposta a un processo già al completo: niente PyWebIO, solo una pagina che si ricarica da sola
+BUSY_HTML = f"""<!DOCTYPE html>
+<html lang="it"><head><meta charset="utf-8"><meta http-equiv="refresh" content="{BUSY_RETRY_AFTER}"><title>Kanji Quiz</title></head>
+<body><p>Il server è al completo. La pagina si ricaricherà da sola tra qualche secondo.</p></body></html>"""
+# Comando toast di PyWebIO inviato direttamente sulla connessione prima di chiudere una sessione inattiva
+IDLE_TOAST = {'command': 'toast', 'task_id': None,
+              'spec': {'content': "Sessione chiusa per inattività: ricarica la pagina per riprendere il quiz.",
+                       'duration': 0, 'position': 'center', 'color': '#1565c0', 'callback_id': None}}
+
+THEMES = ["dark", "sketchy", "minty", "yeti", "default"]
+# Sostituisce il foglio di stile del tema senza ricaricare la pagina e ricorda la scelta nel browser
+THEME_JS = """(function () {
+    if (!theme) {
+        theme = localStorage.getItem('kanji_quiz_theme');
+        if (!theme || !urls[theme]) return;
+    }
+    var link = document.querySelector('link[data-kanji-theme]') || document.querySelector('link[href*="css/bs-theme/"]');
+    link.setAttribute('data-kanji-theme', theme);
+    link.href = urls[theme];
+    document.body.className = document.body.className.replace(/\\s*\\bwebio-theme-\\S+/g, '') + ' webio-theme-' + theme;
+    localStorage.setItem('kanji_quiz_theme', theme);
+})()"""
+
+# Definita una volta per sessione: aggiorna la barra resa da score_bar_html, il feedback e la domanda
+UPDATE_JS = """window.kanjiQuizUpdate = function (correct, total, feedback, clear_question) {
+    var bar = document.getElementById('score-bar');
+    if (bar) {
+        var percentage = total ? correct / total * 100 : 0;
+        document.getElementById('score-empty').style.display = total ? 'none' : '';
+        bar.style.display = total ? '' : 'none';
+        document.getElementById('score-correct').style.width = percentage + '%';
+        document.getElementById('score-correct').textContent = correct;
+        document.getElementById('score-wrong').style.width = (100 - percentage) + '%';
+        document.getElementById('score-wrong').textContent = total - correct || '';
+    }
+    var feedbackScope = document.getElementById('pywebio-scope-feedback');
+    if (feedback !== null && feedbackScope) feedbackScope.innerHTML = feedback;
+    var question = document.getElementById('pywebio-scope-question');
+    if (clear_question && question) question.innerHTML = '';
+};"""
+
+_static_assets = None
+_persist_sessions = False  # in modalità di produzione lo stato delle sessioni è salvato su SQLite
+_live_sessions = weakref.WeakSet()
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+_io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+_open_handlers = set()  # connessioni websocket aperte, ognuna con l'ora dell'ultimo messaggio del client
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+
+def static_assets():
+    """Logo e fogli di stile dei temi, letti una volta sola e tenuti in memoria: nome -> (contenuto, tipo, etag)."""
+    global _static_assets
+    if _static_assets is None:
+        files = {'Logo.png': ("Logo.png", "image/png")}
+        for theme in THEMES:
+            files[f"theme-{theme}.css"] = (os.path.join(STATIC_PATH, 'css', 'bs-theme', f"{theme}.min.css"),
+                                          "text/css; charset=utf-8")
+        assets = {}
+        for name, (path, content_type) in files.items():
+            with open(path, "rb") as f:
+                content = f.read()
+            assets[name] = (content, content_type, hashlib.sha256(content).hexdigest()[:16])
+        _static_assets = assets
+    return _static_assets
+
+
+def asset_url(name):
+    # L'etag nell'URL permette al browser di tenere la risorsa in cache senza chiedere se è cambiata
+    return f"assets/{name}?v={static_assets()[name][2]}"
+
+
+class AssetHandler(tornado.web.RequestHandler):
+    etag = None
+
+    def compute_etag(self):
+        # Etag precalcolato: Tornado risponde 304 se corrisponde a If-None-Match, senza rileggere il contenuto
+        return f'"{self.etag}"' if self.etag else None
+
+    def head(self, name):
+        # Usato da cache e monitoraggio per la rivalidazione: stesse intestazioni della GET, senza corpo
+        return self.get(name, include_body=False)
+
+    def get(self, name, include_body=True):
+        asset = static_assets().get(name)
+        if asset is None:
+            raise tornado.web.HTTPError(404)
+        content, content_type, self.etag = asset
+        self.set_header("Content-Type", content_type)
+        if self.get_query_argument('v', None) == self.etag:
+            self.set_header("Cache-Control", "public, max-age=31536000, immutable")
+        else:
+            self.set_header("Cache-Control", "no-cache")
+        if include_body:
+            self.write(content)
+        else:
+            self.set_header("Content-Length", len(content))
+
+
+class SamplingProfiler:
+    """Profiler a campionamento per una sessione. PyWebIO esegue ogni click in un thread nuovo,
+    quindi a ogni campione si considerano i thread che stanno eseguendo un metodo di `owner`
+    e si conta in quanti campioni compare ogni funzione del loro stack."""
+
+    def __init__(self, owner, interval=PROFILER_INTERVAL):
+        self.owner = owner
+        self.interval = interval
+        self.samples = 0
+        self.counts = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, limit=15):
+        self.stop_event.set()
+        self.thread.join()
+        top = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return self.samples, top
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.thread.ident:
+                    continue
+                locations = []
+                owned = False
+                while frame is not None:
+                    code = frame.f_code
+                    locations.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    owned = owned or frame.f_locals.get('self') is self.owner
+                    frame = frame.f_back
+                if owned:
+                    self.samples += 1
+                    for location in set(locations):
+                        self.counts[location] = self.counts.get(location, 0) + 1
+
+
+def format_wait(seconds):
+    minutes = max(1, round(seconds / 60))
+    if minutes < 60:
+        return f"{minutes} minut{'o' if minutes == 1 else 'i'}"
+    hours = round(minutes / 60)
+    if hours < 24:
+        return f"{hours} or{'a' if hours == 1 else 'e'}"
+    days = round(hours / 24)
+    return f"{days} giorn{'o' if days == 1 else 'i'}"
+
+
+def run_sync(coroutine):
+    """Porta a termine un metodo asincrono di QuizApp in una sessione a thread. Lì input, eval_js e I/O
+    bloccano il thread della sessione e restituiscono subito il valore, quindi la coroutine non si sospende mai."""
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coroutine.close()
+    raise RuntimeError("coroutine sospesa in una sessione a thread")
+
+
+async def run_io(func, *args):
+    """Esegue `func` nell'executor dell'I/O. I task di PyWebIO attendono il future ma non ne propagano
+    l'eccezione, quindi l'esito torna come valore e l'eccezione si rilancia qui, nella coroutine."""
+    def call():
+        try:
+            return True, func(*args)
+        except Exception as e:
+            return False, e
+    ok, value = await asyncio.get_event_loop().run_in_executor(_io_executor, call)
+    if not ok:
+        raise value
+    return value
 
-DATA_FILE = "quiz_data.xlsx"
 
 class QuizApp:
-    def __init__(self):
-        self.initialize_variables()
-        self.load_quiz_data()
-        self.wrong_answers = []
-        self.showing_errors = False
-
-    def initialize_variables(self):
-        self.quiz_categories = []
-        self.quiz_data = {}
-        self.current_category = ""
-        self.current_quiz = None
-        self.correct_answers = 0
-        self.total_questions = 0
-        self.shown_quizzes = {}
-        self.quiz_direction = 'kanji to meaning'
-        self.selected_categories = []
+    def __init__(self, async_io=False):
+        self.async_io = async_io
+        self.engine = QuizEngine()
+        self.profiler = None
         self.last_output = None
         self.score_output = None
         self.show_romaji = False
         self.select_all_clicked = False
-
-    def create_empty_data_file(self):
-        wb = Workbook()
-        ws = wb.active
-        ws.title = 'Data'
-        headers = ['Kanji', 'Romanji', 'Significato', 'Categoria', 'Tipo (Verbo v /Aggettivo a)']
-        for idx, header in enumerate(headers, start=1):
-            ws.cell(row=1, column=idx, value=header)
-            ws.column_dimensions[chr(64 + idx)].width = 30
-        wb.save(DATA_FILE)
-        self.quiz_data['Generale'] = []
-
-    def read_data_from_file(self):
-        wb = load_workbook(DATA_FILE)
-        ws = wb.active
-        all_quizzes = []
-        for row in ws.iter_rows(min_row=2):
-            kanji, romaji, meaning, category, quiz_type = (
-                row[0].value, row[1].value, row[2].value, row[3].value, row[4].value)
-            if quiz_type:
-                quiz_type = quiz_type.lower()
-            if not category or category == "Categoria":
-                category = "Generale"
-            all_quizzes.append({'kanji': kanji, 'romaji': romaji,
-                                'meaning': meaning, 'category': category, 'type': quiz_type})
-        all_quizzes.sort(key=lambda x: x['category'])
-        self.quiz_data = {}
-        for quiz in all_quizzes:
-            category = quiz['category']
-            if category not in self.quiz_data:
-                self.quiz_data[category] = []
-            self.quiz_data[category].append(quiz)
-        self.quiz_categories = list(self.quiz_data.keys())
-
-    def load_quiz_data(self):
+        self.showing_errors = False
+        self.session_saved_at = 0.0
+        self.engine.render = self.render_question
+        self.reset_recap()
+
+    async def ask(self, value):
+        # Nelle sessioni a coroutine input ed eval_js restituiscono un awaitable, in quelle a thread il valore
+        return await value if inspect.isawaitable(value) else value
+
+    async def io(self, func, *args):
+        if self.async_io:
+            return await run_io(func, *args)
+        return func(*args)
+
+    def action(self, method):
+        """Callback di un pulsante per un metodo asincrono: le sessioni a coroutine lo eseguono come task,
+        in quelle a thread va portato a termine nel thread del click."""
+        if self.async_io:
+            return method
+        return lambda *args: run_sync(method(*args))
+
+    async def load_quiz_data(self):
         try:
-            if not os.path.isfile(DATA_FILE):
-                self.create_empty_data_file()
-            else:
-                self.read_data_from_file()
+            await self.io(self.engine.load)
         except Exception as e:
             put_error(f"Errore durante il caricamento dei dati del quiz: {str(e)}")
 
-    def save_quiz_data(self):
-        try:
-            if os.path.isfile(DATA_FILE):
-                wb = load_workbook(DATA_FILE)
-            else:
-                wb = Workbook()
-
-            if "QuizData" in wb.sheetnames:
-                ws = wb["QuizData"]
-            else:
-                ws = wb.create_sheet(title="QuizData")
-
-            # Cancella tutte le righe esistenti prima di scrivere nuovi dati
-            for row in ws.iter_rows(min_row=2, max_row=ws.max_row):
-                for cell in row:
-                    cell.value = None
-
-            # Scrivi l'intestazione delle colonne
-            headers = ['Kanji', 'Romaji', 'Significato', 'Categoria', 'Tipo']
-            for col_num, header in enumerate(headers, start=1):
-                ws.cell(row=1, column=col_num, value=header)
-
-            # Scrivi i nuovi dati
-            row_num = 2
-            for category, quizzes in self.quiz_data.items():
-                for quiz in quizzes:
-                    if not category:
-                        category = "Generale"
-                    for col_num, value in enumerate([quiz['kanji'], quiz['romaji'], quiz['meaning'], category, quiz['type']], start=1):
-                        ws.cell(row=row_num, column=col_num, value=value)
-                    row_num += 1
-
-            wb.save(DATA_FILE)
+    async def refresh_dataset(self):
+        # Con più processi il controllo delle modifiche degli altri legge i file
+        await self.io(self.engine.refresh_dataset)
+
+    async def resume_session(self):
+        """Riprende la sessione salvata dell'utente, anche se era servita da un altro processo."""
+        if not _persist_sessions:
+            return False
+        await self.get_user_id()
+        if not await self.io(self.engine.resume_session):
+            return False
+        put_text("Sessione precedente ripresa.")
+        await self.next_question()
+        return True
+
+    def save_session(self, force=False, flush=False):
+        if not _persist_sessions:
+            return
+        now = time.monotonic()
+        if force or now - self.session_saved_at >= SESSION_SAVE_INTERVAL:
+            self.session_saved_at = now
+            self.engine.save_session()
+            if flush:
+                # Stato finale: un altro processo deve poterlo riprendere subito, senza attendere il blocco di scritture
+                if self.async_io:
+                    _io_executor.submit(flush_progress)
+                else:
+                    flush_progress()
 
+    async def save_quiz_data(self, entry):
+        """True se la modifica è stata salvata; altrimenti mostra l'errore."""
+        try:
+            await self.io(self.engine.save, entry)
         except PermissionError:
             put_error("Impossibile salvare i dati del quiz.")
         except Exception as e:
             put_error(f"Si è verificato un errore durante il salvataggio dei dati del quiz: {str(e)}")
-
-    def next_random_quiz(self):
-        if not hasattr(self, 'selected_categories') or not self.selected_categories:
-            self.show_category_checkboxes()
-            
-        if not self.selected_categories:
-            put_text("Devi selezionare almeno una categoria.")
-            return None
-
-        # Controlla se tutti i quiz di tutte le categorie selezionate sono stati utilizzati
-        all_done = all(len(self.shown_quizzes.get(cat, set())) == len(self.quiz_data.get(cat, [])) for cat in self.selected_categories)
-
-        if all_done:
+        else:
+            return True
+        return False
+
+    async def show_no_question(self):
+        # Nessuna domanda da mostrare: chiede le categorie oppure spiega perché il mazzo è vuoto
+        if not self.engine.selected_categories:
+            await self.show_category_checkboxes()
+            if not self.engine.selected_categories:
+                put_text("Devi selezionare almeno una categoria.")
+        elif self.engine.completed:
             # Mostra un messaggio di completamento e chiedi all'utente di selezionare nuove categorie
             put_text("🎉🎉🎉QUIZ COMPLETATO🎉🎉🎉")
-            self.shown_quizzes = {cat: set() for cat in self.selected_categories}  # Resetta i quiz mostrati per le categorie selezionate
-            self.show_category_checkboxes()
-            return None
-
-        # Prendi una categoria a caso tra quelle selezionate che hanno ancora quiz disponibili
-        available_categories = [cat for cat in self.selected_categories if len(self.shown_quizzes.get(cat, set())) < len(self.quiz_data.get(cat, []))]
-        if not available_categories:
+            await self.show_category_checkboxes()
+        elif self.engine.review_due is not None:
+            put_text(f"Nessun quiz da ripassare per ora: il prossimo ripasso è tra {format_wait(self.engine.review_due - time.time())}.")
+        else:
             put_text("Nessun quiz disponibile nelle categorie selezionate.")
-            return None
-
-        self.current_category = random.choice(available_categories)
-
-        remaining_quizzes = [
-            q for i, q in enumerate(self.quiz_data[self.current_category]) if i not in self.shown_quizzes.get(self.current_category, set())]
-
-        quiz = random.choice(remaining_quizzes)
-        quiz_index = self.quiz_data[self.current_category].index(quiz)
-        self.shown_quizzes.setdefault(self.current_category, set()).add(quiz_index)
-        return quiz
 
     def toggle_romaji(self, clicked_button_value=None):
-        self.show_romaji = not self.show_romaji
+        # Le domande già preparate contengono il romaji secondo l'impostazione precedente
+        with self.engine.prefetch_lock:
+            self.engine.invalidate_prefetch()
+            self.show_romaji = not self.show_romaji
         with use_scope('romaji', clear=True):
             if self.show_romaji:
-                put_text(f"Romaji: {self.current_quiz['romaji']}")
-
-    def next_question(self):
+                put_text(f"Romaji: {self.engine.current_quiz['romaji']}")
+        _prefetch_executor.submit(self.engine.prefetch)
+
+    @metrics.timed('kanji_quiz_next_question_seconds')
+    async def next_question(self, feedback=None):
+        """Mostra la domanda successiva. Con una risposta appena data, feedback e punteggio partono
+        nello stesso script che svuota la domanda precedente: due messaggi in tutto."""
+        await self.refresh_dataset()
+        # Il dataset è già aggiornato (fuori dal loop nella modalità asincrona): il motore non ricontrolla i file
+        question = self.engine.next_question(refresh=False) if self.engine.selected_categories else None
+        self.push_update(feedback, clear_question=question is not None)
+        if question is not None:
+            self.display_question_based_on_direction(question)
+            # Le domande successive si preparano mentre l'utente legge questa
+            _prefetch_executor.submit(self.engine.prefetch)
+            return
         with use_scope('question', clear=True):
-            next_quiz = self.next_random_quiz()
-            
-            if next_quiz is None:
-                return
-
-            self.current_quiz = next_quiz
-            self.display_question_based_on_direction()
-
-            with use_scope('romaji', clear=True):
-                if self.show_romaji:
-                    put_text(f"Romaji: {self.current_quiz['romaji']}")
-
-    def display_question_based_on_direction(self):
-        def get_type(quiz):
-            return f" ({quiz['type']})" if quiz['type'] else ""
-
-        is_kanji_format = bool(self.current_quiz['kanji'])
-        possible_wrong_answers = [quiz for quiz in self.quiz_data[self.current_category] if quiz !=
-                                  self.current_quiz and quiz.get('type') == self.current_quiz.get('type') and bool(quiz['kanji']) == is_kanji_format]
+            await self.show_no_question()
 
-        if len(possible_wrong_answers) < 2:
-            all_other_quizzes = [quiz for cat, quizzes in self.quiz_data.items() for quiz in quizzes if cat !=
-                                 self.current_category and quiz != self.current_quiz and quiz.get('type') == self.current_quiz.get('type') and bool(quiz['kanji']) == is_kanji_format]
-            wrong_answers = random.sample(
-                all_other_quizzes, 2 - len(possible_wrong_answers))
-            wrong_answers.extend(possible_wrong_answers)
-        else:
-            wrong_answers = random.sample(possible_wrong_answers, 2)
-
-        if self.quiz_direction == 'kanji to meaning':
+    def render_question(self, question):
+        # Chiamata dal motore anche fuori dalla sessione, quando prepara le domande in anticipo: solo stringhe
+        if question.direction == 'kanji to meaning':
             question_format = '<span style="color: red; font-size: 24px;">Quale è il significato di questo kanji/katakana: {}?</span>'
-            question_content = self.current_quiz['kanji'] if self.current_quiz['kanji'] else self.current_quiz['romaji']
-            options = [
-                self.current_quiz['meaning'] + get_type(self.current_quiz),
-                wrong_answers[0]['meaning'] + get_type(wrong_answers[0]),
-                wrong_answers[1]['meaning'] + get_type(wrong_answers[1])
-            ]
         else:
             question_format = '<span style="color: blue; font-size: 24px;">Quale kanji/katakana corrisponde a questo significato: {}?</span>'
-            question_content = self.current_quiz['meaning']
-            options = [
-                (self.current_quiz['kanji'] if self.current_quiz['kanji'] else self.current_quiz['romaji']) + get_type(self.current_quiz),
-                (wrong_answers[0]['kanji'] if wrong_answers[0]['kanji'] else wrong_answers[0]['romaji']) + get_type(wrong_answers[0]),
-                (wrong_answers[1]['kanji'] if wrong_answers[1]['kanji'] else wrong_answers[1]['romaji']) + get_type(wrong_answers[1])
-            ]
-
-        put_html(question_format.format(question_content))
-        random.shuffle(options)
-        put_buttons(options, onclick=self.check_answer)
-
-    def check_answer(self, selected_option):
-        with use_scope('feedback', clear=True):
-            correct_answer = self.get_correct_answer()
-            question_text = self.get_question_text()
-            romaji = self.get_romaji()  # Ottieni il romaji associato
-
-            if selected_option == correct_answer:
-                self.correct_answers += 1
-                put_text("Risposta esatta! ✅")
-            else:
-                put_html(f"<div><span style='color: red;'>Risposta errata!</span> ❌<br><span style='color: blue;'>La domanda era:</span> '{question_text}'.<br><span style='color: green;'>La risposta corretta era:</span> {correct_answer}.</div>")
-                # Memorizza la domanda, la risposta corretta, la risposta fornita e il romaji
-                if self.quiz_direction == "kanji to meaning":
-                    self.wrong_answers.append({
-                        'question': f"{question_text} ({romaji})",  # Aggiungi romaji qui
-                        'correct_answer': correct_answer,
-                        'given_answer': selected_option
-                    })
-                else:
-                    self.wrong_answers.append({
-                        'question': question_text,
-                        'correct_answer': f"{correct_answer} ({romaji})",  # Aggiungi romaji qui
-                        'given_answer': selected_option
-                    })
-
-            self.total_questions += 1
-            self.update_score()
-            self.next_question()
-
-
-    def get_romaji(self):
-        return self.current_quiz['romaji']
-
-
-    def show_error_recap(self):
-        with use_scope('errors', clear=True):  # Usa un nuovo scope per gli errori
-            if not self.showing_errors:
-                for error in self.wrong_answers:
-                    put_html(f"<span style='color: blue;'>Domanda:</span> {error['question']}<br>")
-                    put_html(f"<span style='color: green;'>Risposta corretta:</span> {error['correct_answer']}<br>")
-                    put_html(f"<span style='color: red;'>Risposta fornita:</span> {error['given_answer']}<br>")
-                    put_markdown("---")
-                self.showing_errors = True
-            else:
-                self.showing_errors = False
-
-        
-    def get_correct_answer(self):
-        if self.quiz_direction == 'kanji to meaning':
-            correct_answer = self.current_quiz['meaning']
-        else:
-            correct_answer = self.current_quiz['kanji'] if self.current_quiz['kanji'] else self.current_quiz['romaji']
-
-        if self.current_quiz.get('type'):
-            correct_answer += f" ({self.current_quiz['type']})"
-        return correct_answer
-
-    def get_question_text(self):
-        if self.quiz_direction == 'kanji to meaning':
-            question_text = f"Quale è il significato di questo kanji/katakana: {self.current_quiz['kanji'] if self.current_quiz['kanji'] else self.current_quiz['romaji']}?"
+        romaji = f"Romaji: {question.quiz['romaji']}" if self.show_romaji else None
+        return question_format.format(html.escape(str(question.prompt))), romaji
+
+    @metrics.timed('kanji_quiz_render_question_seconds')
+    def display_question_based_on_direction(self, question):
+        prompt_html, romaji = question.rendered
+        put_scope('question_body', [
+            put_html(prompt_html),
+            put_buttons(question.options, onclick=self.action(self.check_answer)),
+            put_scope('romaji', [put_text(romaji)] if romaji is not None else []),
+        ], scope='question')
+
+    @metrics.timed('kanji_quiz_answer_seconds')
+    async def check_answer(self, selected_option):
+        await self.get_user_id()
+        result = self.engine.answer(selected_option)
+        self.save_session()
+
+        if result.correct:
+            feedback = "<p>Risposta esatta! ✅</p>"
         else:
-            question_text = f"Quale kanji/katakana corrisponde a questo significato: {self.current_quiz['meaning']}?"
-        return question_text
+            feedback = (f"<div><span style='color: red;'>Risposta errata!</span> ❌<br><span style='color: blue;'>La domanda era:</span> "
+                        f"'{html.escape(result.question_text)}'.<br><span style='color: green;'>La risposta corretta era:</span> "
+                        f"{html.escape(result.correct_answer)}.</div>")
+        await self.next_question(feedback)
+
+    def push_update(self, feedback=None, clear_question=False):
+        # Un solo messaggio: contatori e larghezze della barra del punteggio, feedback, pulizia della domanda
+        correct, total = self.engine.score()
+        run_js("kanjiQuizUpdate(correct, total, feedback, clear_question)",
+               correct=correct, total=total, feedback=feedback, clear_question=clear_question)
+
+
+    def reset_recap(self):
+        # Errori raggruppati per domanda: (quiz, direzione) -> [id, numero di errori, risposte fornite]
+        self.recap_groups = {}
+        self.recap_order = []
+        self.recap_seen_seq = 0
+        self.recap_rendered = 0
+        self.recap_limit = RECAP_PAGE_SIZE
+        self.recap_created = False
+
+    def collect_mistakes(self):
+        """Aggiunge ai gruppi gli errori arrivati dopo l'ultimo riepilogo e restituisce gli id dei gruppi cambiati."""
+        changed = set()
+        for error in self.engine.wrong_answers:
+            if error.seq <= self.recap_seen_seq:
+                continue
+            key = (error.quiz, error.direction)
+            group = self.recap_groups.get(key)
+            if group is None:
+                group = self.recap_groups[key] = [len(self.recap_order), 0, []]
+                self.recap_order.append(key)
+            group[1] += 1
+            if error.given_answer not in group[2]:
+                group[2].append(error.given_answer)
+            changed.add(group[0])
+            self.recap_seen_seq = error.seq
+        return changed
+
+    def render_recap_groups(self):
+        # Un solo messaggio per pagina: i gruppi già mostrati non vengono riscritti
+        new_keys = self.recap_order[self.recap_rendered:self.recap_limit]
+        if new_keys:
+            blocks = []
+            for key in new_keys:
+                group_id, count, given = self.recap_groups[key]
+                question, correct_answer = describe_mistake(*key)
+                blocks.append(
+                    f"<div><span style='color: blue;'>Domanda:</span> {html.escape(str(question))}<br>"
+                    f"<span style='color: green;'>Risposta corretta:</span> {html.escape(str(correct_answer))}<br>"
+                    f"<span style='color: red;'>Risposta fornita:</span> <span id='recap-given-{group_id}'>{html.escape(', '.join(given))}</span><br>"
+                    f"<span style='color: red;'>Errori:</span> <span id='recap-count-{group_id}'>{count}</span></div><hr>")
+            with use_scope('errors'):
+                put_html("".join(blocks))
+            self.recap_rendered += len(new_keys)
+        with use_scope('errors_more', clear=True):
+            hidden = len(self.recap_order) - self.recap_rendered
+            if hidden > 0:
+                put_buttons([dict(label=f'Carica altri ({hidden})', value='more', color='secondary')],
+                            onclick=self.load_more_errors, small=True)
+
+    def load_more_errors(self, _=None):
+        self.recap_limit += RECAP_PAGE_SIZE
+        self.render_recap_groups()
 
-    def update_score(self):
-        with use_scope('score', clear=True):
-            correct_percentage = (self.correct_answers / self.total_questions) * 100 if self.total_questions else 0
-            wrong_percentage = 100 - correct_percentage
+    def show_error_recap(self):
+        if self.showing_errors:
+            self.showing_errors = False
+            run_js("document.getElementById('pywebio-scope-recap').style.display = 'none'")
+            return
 
-            # Se non ci sono domande, rendi la barra trasparente e non mostrare il testo
-            if self.total_questions == 0:
-                put_html('<div style="height: 40px; border-radius: 15px;"></div>')  # Barra vuota
+        self.showing_errors = True
+        changed = self.collect_mistakes()
+        if not self.recap_created:
+            with use_scope('recap', clear=True):  # Usa un nuovo scope per gli errori
+                put_scope('errors')
+                put_scope('errors_more')
+            self.recap_created = True
+        # Aggiorna con un solo messaggio i contatori dei gruppi già mostrati, poi rende visibile il riepilogo
+        updates = [[group_id, count, ', '.join(given)]
+                   for group_id, count, given in (self.recap_groups[self.recap_order[i]] for i in changed)
+                   if group_id < self.recap_rendered]
+        run_js("""for (const [id, count, given] of updates) {
+                    document.getElementById('recap-count-' + id).textContent = count;
+                    document.getElementById('recap-given-' + id).textContent = given;
+                }
+                document.getElementById('pywebio-scope-recap').style.display = '';""", updates=updates)
+        self.render_recap_groups()
+
+
+    async def show_statistics(self):
+        user_id = await self.get_user_id()
+        with use_scope('stats', clear=True):
+            rates = await self.io(category_error_rates, user_id)
+            if not rates:
+                put_text("Nessuna risposta registrata finora.")
                 return
+            put_table([[category, total, f"{errors / total:.0%}"] for category, total, errors in rates],
+                      header=['Categoria', 'Risposte', 'Errori'])
+            missed = await self.io(most_missed, user_id)
+            if missed:
+                put_table([[key.replace("\x1f", " - "), misses] for key, misses in missed],
+                          header=['Quiz sbagliati più spesso', 'Errori'])
 
-            # Testo per il numero di risposte corrette
-            correct_text = f"{self.correct_answers}"
-
-            # Testo per il numero di risposte errate
-            wrong_answers = self.total_questions - self.correct_answers
-            wrong_text = f"{wrong_answers}" if wrong_answers > 0 else ""
-
-            progress_bar = f"""
-            <div style="background-color: #f3f3f3; border-radius: 15px; padding: 3px; box-shadow: 0 2px 4px rgba(0, 0, 0, 0.1);" onclick="show_error_recap()">
-                <div style="display: flex; align-items: center; justify-content: center; transition: width 0.3s ease;">
-                    <div style="width: {correct_percentage}%; background: linear-gradient(to right, #4CAF50, #8BC34A); text-align: center; padding: 10px 0; border-radius: 12px; transition: width 0.3s ease;">
-                        {correct_text}
-                    </div>
-                    <div style="width: {wrong_percentage}%; background: linear-gradient(to right, #FF5733, #FFC107); text-align: center; padding: 10px 0; border-radius: 12px; transition: width 0.3s ease;">
-                        {wrong_text}
-                    </div>
-                </div>
-            </div>
-            """
-            put_html(progress_bar)
-
-
-
+    def update_score(self):
+        self.push_update()
 
     def reset_score(self):
-        self.correct_answers = 0
-        self.total_questions = 0
+        self.engine.reset_score()  # Azzera anche gli errori salvati
         self.update_score()
-        self.wrong_answers = []  # Aggiunto per eliminare gli errori salvati
         self.showing_errors = False  # Aggiunto per nascondere gli errori mostrati
-        with use_scope('errors', clear=True):  # Aggiunto per pulire l'area degli errori
+        self.reset_recap()
+        self.save_session(force=True)
+        with use_scope('recap', clear=True):  # Aggiunto per pulire l'area degli errori
             pass
 
-    def switch_mode(self):
-        if self.quiz_direction == 'kanji to meaning':
-            self.quiz_direction = 'meaning to kanji'
-        else:
-            self.quiz_direction = 'kanji to meaning'
-        self.next_question()
+    async def switch_mode(self):
+        self.engine.switch_direction()
+        self.save_session(force=True)
+        await self.next_question()
+
+    def toggle_profiler(self, _=None):
+        with use_scope('profile', clear=True):
+            if self.profiler is None:
+                self.profiler = SamplingProfiler(self)
+                self.profiler.start()
+                put_text("Profiler di sessione attivo: usa il quiz e premi di nuovo per vedere i risultati.")
+            else:
+                samples, top = self.profiler.stop()
+                self.profiler = None
+                put_text(f"Campioni raccolti: {samples}")
+                if samples:
+                    put_table([[location, count, f"{count / samples:.0%}"] for location, count in top],
+                              header=['Funzione', 'Campioni', 'Quota'])
+
+    async def toggle_review_mode(self):
+        with use_scope('feedback', clear=True):
+            if self.engine.review_queue is None:
+                await self.get_user_id()
+                await self.io(self.engine.enable_review)
+                put_text("Ripetizione dilazionata attiva: i quiz sbagliati tornano prima, quelli noti più avanti.")
+            else:
+                self.engine.disable_review()
+                put_text("Ripetizione dilazionata disattivata.")
+        self.save_session(force=True)
+        await self.next_question()
+
+    async def get_user_id(self):
+        # Identificativo anonimo conservato nel browser, per ritrovare lo stato dell'utente tra una visita e l'altra
+        if self.engine.user_id is None:
+            self.engine.user_id = await self.ask(eval_js(USER_ID_JS))
+        return self.engine.user_id
 
     def clear_categories(self):
-        if hasattr(self, 'selected_categories'):
-            delattr(self, 'selected_categories')
+        self.engine.select_categories([])
         put_text("Le categorie selezionate sono state cancellate. Sarai in grado di selezionarne di nuove.")
 
-    def handle_category_selection(self, selected_categories):
+    async def handle_category_selection(self, selected_categories):
         if selected_categories:
-            self.selected_categories = selected_categories
-            self.current_category = random.choice(self.selected_categories)
-            self.next_question()
+            self.engine.select_categories(selected_categories)
+            self.save_session(force=True)
+            await self.next_question()
         else:
             put_text("Devi selezionare almeno una categoria.")
 
-    def select_all_categories(self):
-        self.selected_categories = self.quiz_categories.copy()
-        self.show_category_checkboxes()
+    async def select_all_categories(self):
+        self.engine.selected_categories = self.engine.quiz_categories.copy()
+        await self.show_category_checkboxes()
 
-    def show_category_checkboxes(self):
-        options = ['Seleziona tutto'] + self.quiz_categories
-        selected_categories = checkbox("Seleziona una o più categorie", options=options, value=self.selected_categories)
+    async def show_category_checkboxes(self):
+        await self.refresh_dataset()
+        options = ['Seleziona tutto'] + self.engine.quiz_categories
+        selected_categories = await self.ask(checkbox("Seleziona una o più categorie", options=options, value=self.engine.selected_categories))
         
         if 'Seleziona tutto' in selected_categories:
-            self.selected_categories = self.quiz_categories.copy()
-            self.handle_category_selection(self.selected_categories)  # Simula un clic su "Submit"
+            await self.handle_category_selection(self.engine.quiz_categories.copy())  # Simula un clic su "Submit"
             return
 
-        self.handle_category_selection(selected_categories)
+        await self.handle_category_selection(selected_categories)
 
-    def add_category(self):
-        category = input("Aggiungi Categoria", type=TEXT, placeholder="Inserisci il nome della categoria")
+    async def add_category(self):
+        await self.refresh_dataset()
+        category = await self.ask(input("Aggiungi Categoria", type=TEXT, placeholder="Inserisci il nome della categoria"))
         if category:
-            if category not in self.quiz_categories:
-                self.quiz_categories.append(category)
-                self.quiz_data[category] = []
-                put_text('La categoria è stata aggiunta con successo!')
-                self.save_quiz_data()
+            if category not in self.engine.quiz_categories:
+                # Il controllo definitivo avviene al salvataggio, sull'ultima versione dei dati
+                if await self.save_quiz_data({'op': 'add_category', 'category': category}):
+                    put_text('La categoria è stata aggiunta con successo!')
             else:
                 put_error('Errore: La categoria esiste già.')
 
-    def edit_category(self):
-        selected_category = select("Seleziona una categoria da modificare", type=SELECT, options=self.quiz_categories)
+    async def edit_category(self):
+        await self.refresh_dataset()
+        selected_category = await self.ask(select("Seleziona una categoria da modificare", type=SELECT, options=self.engine.quiz_categories))
         if selected_category:
-            new_category_name = input(f"Modifica il nome della categoria '{selected_category}':", type=TEXT)
+            new_category_name = await self.ask(input(f"Modifica il nome della categoria '{selected_category}':", type=TEXT))
             if new_category_name:
-                if new_category_name not in self.quiz_categories:
-                    self.quiz_data[new_category_name] = self.quiz_data.pop(selected_category)
-                    self.quiz_categories.remove(selected_category)
-                    self.quiz_categories.append(new_category_name)
-                    self.quiz_categories.sort()
-                    self.save_quiz_data()
+                if new_category_name not in self.engine.quiz_categories:
+                    await self.save_quiz_data({'op': 'rename_category', 'category': selected_category, 'name': new_category_name})
                 else:
                     put_error('Errore: La categoria esiste già.')
 
-    def edit_quiz(self):
-        selected_category = select("Seleziona una categoria per modificare un quiz", type=SELECT, options=self.quiz_categories)
-        if selected_category:
-            if selected_category not in self.quiz_data or not self.quiz_data[selected_category]:
-                put_text('La categoria selezionata non contiene ancora quiz. Aggiungine uno prima di modificarlo.')
-                return
-
-            quiz_list = [f"{quiz['kanji']} - {quiz['meaning']}" for quiz in self.quiz_data[selected_category]]
-            selected_quiz_str = select("Seleziona un quiz da modificare", type=SELECT, options=quiz_list)
+    async def edit_quiz(self):
+        await self.refresh_dataset()
+        selected_category = await self.ask(select("Seleziona una categoria per modificare un quiz", type=SELECT, options=self.engine.quiz_categories))
+        if not selected_category:
+            return
+        if selected_category not in self.engine.quiz_data or not self.engine.quiz_data[selected_category]:
+            put_text('La categoria selezionata non contiene ancora quiz. Aggiungine uno prima di modificarlo.')
+            return
 
-            # Trova il quiz selezionato
-            for quiz in self.quiz_data[selected_category]:
-                if f"{quiz['kanji']} - {quiz['meaning']}" == selected_quiz_str:
-                    selected_quiz = quiz
-                    break
+        query = await self.ask(input("Cerca un quiz da modificare (kanji, romaji o significato; vuoto per vederli tutti):", type=TEXT))
+        page = 0
+        while True:
+            # Solo la pagina richiesta viaggia fino al browser; i quiz sono indicati dalla loro posizione nella categoria.
+            # Costruire l'indice di una categoria grande richiede tempo, quindi anche la ricerca passa dall'executor
+            results, total = await self.io(search_quizzes, self.engine.quiz_data, selected_category, query, page, EDIT_PAGE_SIZE)
+            if not total:
+                put_text("Nessun quiz trovato.")
+                return
+            options = [{'label': f"{quiz['kanji'] or ''} - {quiz['romaji'] or ''} - {quiz['meaning'] or ''}", 'value': quiz_id}
+                       for quiz_id, quiz in results]
+            if page > 0:
+                options.append({'label': "« Risultati precedenti", 'value': 'previous'})
+            if (page + 1) * EDIT_PAGE_SIZE < total:
+                options.append({'label': "Risultati successivi »", 'value': 'next'})
+            first = page * EDIT_PAGE_SIZE + 1
+            choice = await self.ask(select(f"Seleziona un quiz da modificare ({first}-{first + len(results) - 1} di {total})",
+                                           type=SELECT, options=options))
+            if choice == 'previous':
+                page -= 1
+            elif choice == 'next':
+                page += 1
+            else:
+                break
 
-        if selected_quiz is None:
-            put_text("Quiz non trovato.")
-            return
+        quiz_index = choice
+        selected_quiz = self.engine.quiz_data[selected_category][quiz_index]
 
         # Utilizzo di input singoli invece di input_group
-        kanji = input("Modifica Kanji:", type=TEXT, value=selected_quiz.get('kanji', ''))
-        meaning = input("Modifica Significato:", type=TEXT, value=selected_quiz.get('meaning', ''))
-        romaji = input("Modifica Romaji:", type=TEXT, value=selected_quiz.get('romaji', ''))
-        quiz_type = input("Modifica Tipo (a/v):", type=TEXT, value=selected_quiz.get('type', ''))
+        kanji = await self.ask(input("Modifica Kanji:", type=TEXT, value=selected_quiz.get('kanji') or ''))
+        meaning = await self.ask(input("Modifica Significato:", type=TEXT, value=selected_quiz.get('meaning') or ''))
+        romaji = await self.ask(input("Modifica Romaji:", type=TEXT, value=selected_quiz.get('romaji') or ''))
+        quiz_type = await self.ask(input("Modifica Tipo (a/v):", type=TEXT, value=selected_quiz.get('type') or ''))
 
         # Aggiorna il quiz
-        selected_quiz.update({'kanji': kanji, 'meaning': meaning, 'romaji': romaji, 'type': quiz_type})
-        self.save_quiz_data()
+        await self.save_quiz_data({'op': 'edit_quiz', 'category': selected_category, 'index': quiz_index,
+                             'quiz': {'kanji': kanji, 'meaning': meaning, 'romaji': romaji, 'type': quiz_type}})
 
-    def add_quiz(self):
-        selected_category = select("Seleziona una categoria per aggiungere un quiz", type=SELECT, options=self.quiz_categories)
+    async def add_quiz(self):
+        await self.refresh_dataset()
+        selected_category = await self.ask(select("Seleziona una categoria per aggiungere un quiz", type=SELECT, options=self.engine.quiz_categories))
         if selected_category:
-            kanji = input("Inserisci Kanji:", type=TEXT)
-            meaning = input("Inserisci Significato:", type=TEXT)
-            romaji = input("Inserisci Romaji:", type=TEXT)
-            quiz_type = input("Inserisci Tipo (a/v):", type=TEXT)
+            kanji = await self.ask(input("Inserisci Kanji:", type=TEXT))
+            meaning = await self.ask(input("Inserisci Significato:", type=TEXT))
+            romaji = await self.ask(input("Inserisci Romaji:", type=TEXT))
+            quiz_type = await self.ask(input("Inserisci Tipo (a/v):", type=TEXT))
             
             if romaji and meaning:
-                self.quiz_data[selected_category].append({'kanji': kanji, 'romaji': romaji, 'meaning': meaning, 'category': selected_category, 'type': quiz_type})
-                self.save_quiz_data()
+                await self.save_quiz_data({'op': 'add_quiz', 'category': selected_category,
+                                     'quiz': {'kanji': kanji, 'romaji': romaji, 'meaning': meaning, 'type': quiz_type}})
             else:
                 put_error('Errore: Inserisci sia il kanji che il significato.')
 
@@ -420,26 +635,48 @@ class QuizApp:
         put_html("<script>location.reload();</script>")
 
 
-    def select_theme(self, btn_val=None):
-        theme_options = ["dark", "sketchy", "minty", "yeti", "default"]
-        selected_theme = select("Seleziona un tema", options=theme_options)
+    async def select_theme(self, btn_val=None):
+        selected_theme = await self.ask(select("Seleziona un tema", options=THEMES))
         self.apply_theme(selected_theme)
 
-    def apply_theme(self, theme_name):
-        config(theme=theme_name)
-        self.reload_page()
+    def apply_theme(self, theme_name=None):
+        # Senza nome applica il tema salvato nel browser, se ce n'è uno
+        run_js(THEME_JS, theme=theme_name, urls={theme: asset_url(f"theme-{theme}.css") for theme in THEMES})
 
 
 def main():
     """Kanji Quiz"""
-    
+    run_sync(start_session(QuizApp()))
+    hold()
+
+
+async def async_main():
+    """Kanji Quiz"""
+    # Sessione a coroutine: gira nel loop di Tornado, senza un thread per sessione e uno per click
+    await start_session(QuizApp(async_io=True))
+    await hold()
+
+
+async def start_session(quiz_app):
     # Nascondi il footer
     hide_footer()
 
-    quiz_app = QuizApp()
+    metrics.inc('kanji_quiz_sessions_started_total')
+    metrics.inc('kanji_quiz_sessions_active', kind='gauge')
+    defer_call(session_ended)
+
+    await quiz_app.load_quiz_data()
+    _live_sessions.add(quiz_app)
+
+    def end_session():
+        # Tolta subito: finché il GC non raccoglie il QuizApp, un SIGTERM salverebbe questo stato ormai vecchio
+        # sopra quello più recente salvato dallo stesso utente su un altro processo
+        _live_sessions.discard(quiz_app)
+        quiz_app.save_session(force=True, flush=True)
+    defer_call(end_session)
     
     # Mostra il titolo e le categorie
-    display_intro(quiz_app)
+    await display_intro(quiz_app)
 
     # Mostra lo score
     display_score(quiz_app)
@@ -455,8 +692,10 @@ def main():
 
     # Mostra il pulsante per cambiare il tema
     display_theme_selector(quiz_app)
-    
-    hold()
+
+def session_ended():
+    metrics.inc('kanji_quiz_sessions_ended_total')
+    metrics.inc('kanji_quiz_sessions_active', -1, kind='gauge')
 
 def hide_footer():
     put_html("""
@@ -467,28 +706,46 @@ def hide_footer():
     </style>
     """)
 
-def display_intro(quiz_app):
-    with open("Logo.png", "rb") as f:
-        img_content = f.read()
-    put_image(img_content, format="png", width="300px")  # Puoi regolare la larghezza come preferisci
-    quiz_app.show_category_checkboxes()
+async def display_intro(quiz_app):
+    run_js(UPDATE_JS)
+    quiz_app.apply_theme()
+    put_image(asset_url('Logo.png'), width="300px")  # Puoi regolare la larghezza come preferisci
+    put_scope('question')
+    if not await quiz_app.resume_session():
+        await quiz_app.show_category_checkboxes()
     put_markdown("---")
 
 
 def display_score(quiz_app):
     with use_scope('score'):
-        quiz_app.update_score()
+        # La barra è resa una volta sola, poi si aggiornano solo contatori e larghezze
+        put_html(score_bar_html(*quiz_app.engine.score()))
     with use_scope('feedback', clear=True):
         pass
     put_markdown("---")
 
+def score_bar_html(correct, total):
+    correct_percentage = correct / total * 100 if total else 0
+    # Se non ci sono domande, al posto della barra c'è uno spazio trasparente senza testo
+    return f"""
+    <div id="score-empty" style="height: 40px; border-radius: 15px; {'display: none;' if total else ''}"></div>
+    <div id="score-bar" style="background-color: #f3f3f3; border-radius: 15px; padding: 3px; box-shadow: 0 2px 4px rgba(0, 0, 0, 0.1); {'' if total else 'display: none;'}" onclick="show_error_recap()">
+        <div style="display: flex; align-items: center; justify-content: center; transition: width 0.3s ease;">
+            <div id="score-correct" style="width: {correct_percentage}%; background: linear-gradient(to right, #4CAF50, #8BC34A); text-align: center; padding: 10px 0; border-radius: 12px; transition: width 0.3s ease;">{correct}</div>
+            <div id="score-wrong" style="width: {100 - correct_percentage}%; background: linear-gradient(to right, #FF5733, #FFC107); text-align: center; padding: 10px 0; border-radius: 12px; transition: width 0.3s ease;">{total - correct or ''}</div>
+        </div>
+    </div>
+    """
+
 def display_main_actions(quiz_app):
     put_text("🔄")
     put_buttons([
         dict(label='Resetta Punteggio/Errori', value='reset_score', color='warning'),
         dict(label='Mostra/Nascondi Romaji', value='toggle_romaji', color='secondary'),
-        dict(label='Mostra/Nascondi Errori', value='show_errors', color='secondary')
-    ], onclick=[quiz_app.reset_score, quiz_app.toggle_romaji, quiz_app.show_error_recap])
+        dict(label='Mostra/Nascondi Errori', value='show_errors', color='secondary'),
+        dict(label='Statistiche', value='show_statistics', color='secondary')
+    ], onclick=[quiz_app.reset_score, quiz_app.toggle_romaji, quiz_app.show_error_recap,
+                quiz_app.action(quiz_app.show_statistics)])
     put_markdown("---")
 
 def display_settings(quiz_app):
@@ -497,8 +754,13 @@ def display_settings(quiz_app):
         put_buttons([
             dict(label='Cambia modalità', value='switch_mode', color='info'),
             dict(label='Quiz Successivo', value='next_question', color='success'),
-            dict(label='Cambia categorie', value='change_categories', color='info')
-        ], onclick=[quiz_app.switch_mode, quiz_app.next_question, quiz_app.show_category_checkboxes])
+            dict(label='Cambia categorie', value='change_categories', color='info'),
+            dict(label='Ripetizione dilazionata', value='review_mode', color='secondary')
+        ], onclick=[quiz_app.action(quiz_app.switch_mode), quiz_app.action(quiz_app.next_question),
+                    quiz_app.action(quiz_app.show_category_checkboxes), quiz_app.action(quiz_app.toggle_review_mode)])
+        if metrics.enabled:
+            put_buttons([dict(label='Profilo sessione', value='profile', color='secondary')],
+                        onclick=quiz_app.toggle_profiler, small=True)
     put_markdown("---")
 
 def display_edit_actions(quiz_app):
@@ -509,15 +771,134 @@ def display_edit_actions(quiz_app):
             dict(label='Modifica categoria', value='edit_category', color='danger'),
             dict(label='Aggiungi Quiz', value='add_quiz', color='success'),
             dict(label='Modifica Quiz', value='edit_quiz', color='danger')
-        ], onclick=[quiz_app.add_category, quiz_app.edit_category, quiz_app.add_quiz, quiz_app.edit_quiz], small=True)        
+        ], onclick=[quiz_app.action(quiz_app.add_category), quiz_app.action(quiz_app.edit_category),
+                    quiz_app.action(quiz_app.add_quiz), quiz_app.action(quiz_app.edit_quiz)], small=True)        
     put_markdown("---")
 
 def display_theme_selector(quiz_app):
     put_buttons([
         dict(label='Seleziona Tema', value='select_theme', color='info')
-    ], onclick=quiz_app.select_theme, outline=True)
+    ], onclick=quiz_app.action(quiz_app.select_theme), outline=True)
+
 
 
+def save_live_sessions(signum, frame):
+    # Arresto del processo: salva le sessioni aperte, che i client riprenderanno su un altro processo
+    for quiz_app in list(_live_sessions):
+        quiz_app.save_session(force=True)
+    flush_progress()
+    sys.exit(0)
+
+
+def session_handler(app, max_sessions=None):
+    """Handler di PyWebIO per `app` che registra l'ora dell'ultimo messaggio di ogni connessione.
+    Con `max_sessions` sessioni già aperte risponde 503 con una pagina minima, senza avviarne un'altra."""
+
+    class SessionHandler(webio_handler(app)):
+        async def get(self, *args, **kwargs):
+            if max_sessions is not None and len(_open_handlers) >= max_sessions:
+                metrics.inc('kanji_quiz_sessions_rejected_total')
+                self.set_status(503)
+                self.set_header("Retry-After", str(BUSY_RETRY_AFTER))
+                self.set_header("Cache-Control", "no-store")
+                self.finish(BUSY_HTML)
+                return
+            await super().get(*args, **kwargs)
+
+        def open(self):
+            self.last_activity = time.monotonic()
+            _open_handlers.add(self)
+            super().open()
+
+        def on_message(self, message):
+            self.last_activity = time.monotonic()
+            super().on_message(message)
+
+        def on_close(self):
+            _open_handlers.discard(self)
+            super().on_close()
+
+    return SessionHandler
+
+
+def reap_idle_sessions(idle_timeout):
+    """Chiude le connessioni che non ricevono messaggi dal client da più di `idle_timeout` secondi.
+    Chiudendo la connessione PyWebIO chiude la sessione: le defer_call salvano lo stato e liberano le risorse."""
+    now = time.monotonic()
+    for handler in list(_open_handlers):
+        if now - handler.last_activity > idle_timeout:
+            metrics.inc('kanji_quiz_sessions_reaped_total')
+            handler.write_message(IDLE_TOAST)
+            handler.close()
+
+
+def make_app(debug=False, autoreload=None, async_sessions=False, max_sessions=None, idle_timeout=None):
+    global _persist_sessions
+    static_assets()  # Letti all'avvio, non alla prima sessione
+    Session.debug = debug
+    if idle_timeout:
+        # Chi ricarica la pagina dopo la chiusura per inattività riprende la sessione salvata
+        _persist_sessions = True
+        tornado.ioloop.PeriodicCallback(lambda: reap_idle_sessions(idle_timeout),
+                                        min(REAPER_INTERVAL, idle_timeout / 4) * 1000).start()
+    return tornado.web.Application([
+        (r"/", session_handler(async_main if async_sessions else main, max_sessions)),
+        (r"/assets/(.*)", AssetHandler),
+        (r"/(.*)", tornado.web.StaticFileHandler, {"path": STATIC_PATH, 'default_filename': 'index.html'}),
+    ], websocket_ping_interval=30, compress_response=True, debug=debug,
+        autoreload=debug if autoreload is None else autoreload)
+
+
+def serve(host, port, debug=True, **options):
+    make_app(debug, **options).listen(port, host)
+    tornado.ioloop.IOLoop.current().start()
+
+
+def serve_workers(workers, host, port, debug=False, metrics_port=None, **options):
+    """Modalità di produzione: `workers` processi (0 = uno per core) accettano le connessioni sulla stessa porta.
+    Lo stato delle sessioni è salvato su SQLite, quindi un client che si riconnette la riprende su qualsiasi processo."""
+    global _persist_sessions
+    sockets = tornado.netutil.bind_sockets(port, host)
+    task_id = tornado.process.fork_processes(workers)
+    _persist_sessions = True
+    share_data_files()
+    signal.signal(signal.SIGTERM, save_live_sessions)
+    signal.signal(signal.SIGINT, save_live_sessions)
+    if metrics_port:
+        metrics.enabled = True
+        tornado.web.Application([(r"/metrics", MetricsHandler)]).listen(metrics_port + task_id)
+    server = tornado.httpserver.HTTPServer(make_app(debug, autoreload=False, **options))  # autoreload non funziona con fork
+    server.add_sockets(sockets)
+    tornado.ioloop.IOLoop.current().start()
+
 
 if __name__ == "__main__":
-    start_server(main, host='0.0.0.0', debug=True, port=80)
+    parser = argparse.ArgumentParser(description="Kanji Quiz")
+    parser.add_argument('--compact', action='store_true',
+                        help="riporta nel file Excel le modifiche del journal ed esce")
+    parser.add_argument('--metrics-port', type=int,
+                        help="attiva le metriche e le espone in formato Prometheus su http://<host>:<porta>/metrics "
+                             "(con --workers, ogni processo usa la porta indicata più il proprio numero)")
+    parser.add_argument('--workers', type=int,
+                        help="modalità di produzione con più processi sulla stessa porta (0 = uno per core), "
+                             "sessioni salvate su SQLite e debug disattivato")
+    parser.add_argument('--port', type=int, default=80)
+    parser.add_argument('--debug', action='store_true', help="debug di Tornado anche in modalità di produzione")
+    parser.add_argument('--async', dest='async_sessions', action='store_true',
+                        help="sessioni a coroutine nel loop di Tornado, con l'I/O su file in un executor limitato")
+    parser.add_argument('--max-sessions', type=int,
+                        help="sessioni aperte al massimo per processo; oltre, i client ricevono una pagina \"occupato\"")
+    parser.add_argument('--idle-timeout', type=float,
+                        help="secondi senza attività dopo i quali una sessione viene salvata e chiusa")
+    args = parser.parse_args()
+    options = dict(async_sessions=args.async_sessions, max_sessions=args.max_sessions, idle_timeout=args.idle_timeout)
+
+    if args.compact:
+        compact_journal()
+    elif args.workers is not None:
+        serve_workers(args.workers, '0.0.0.0', args.port, debug=args.debug, metrics_port=args.metrics_port, **options)
+    else:
+        if args.metrics_port:
+            metrics.enabled = True
+            tornado.web.Application([(r"/metrics", MetricsHandler)]).listen(args.metrics_port)
+        serve('0.0.0.0', args.port, debug=True, **options)
@@ -0,0 +1,204 @@
+"""Kanji Quiz engine benchmark
+
+Micro-benchmark dei percorsi caldi di QuizEngine (caricamento, domanda successiva, risposta, salvataggio)
+su mazzi sintetici, senza interfaccia né server. Per ogni misura riporta min/media/mediana/deviazione
+e operazioni al secondo, come pytest-benchmark; con --json salva i risultati per confrontare due commit.
+Misura anche, con tracemalloc, la memoria del mazzo condiviso e quella di ogni sessione.
+
+    python bench_engine.py --sizes 1000 10000 100000 --json bench_results.json
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from loadtest import build_deck
+import quiz_engine
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_benchmark(func, setup=None, min_rounds=5, max_time=1.0):
+    """Esegue `func` finché non sono passati `max_time` secondi e almeno `min_rounds` giri.
+    `setup`, se presente, prepara ogni giro e non entra nella misura."""
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < min_rounds or time.perf_counter() - started < max_time:
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {
+        'rounds': len(timings),
+        'min': min(timings),
+        'max': max(timings),
+        'mean': statistics.mean(timings),
+        'median': statistics.median(timings),
+        'stddev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        'ops': len(timings) / sum(timings) if sum(timings) else None,
+    }
+
+
+def forget_dataset():
+    # Simula un processo appena avviato: i dati condivisi vanno riletti dai file
+    quiz_engine._dataset = None
+    quiz_engine._journal_entries = 0
+    del quiz_engine._category_renames[:]
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def new_engine():
+    engine = quiz_engine.QuizEngine(user_id='bench')
+    engine.load()
+    engine.select_categories(engine.quiz_categories)
+    return engine
+
+
+def bench_deck(size, categories, max_time):
+    build_deck(quiz_engine.DATA_FILE, size, categories)
+    remove_file(quiz_engine.SNAPSHOT_FILE)
+    remove_file(quiz_engine.JOURNAL_FILE)
+    results = {}
+
+    def drop_snapshot():
+        forget_dataset()
+        remove_file(quiz_engine.SNAPSHOT_FILE)
+    results['load_xlsx'] = run_benchmark(quiz_engine.get_quiz_dataset, drop_snapshot, min_rounds=2, max_time=max_time)
+    results['load_snapshot'] = run_benchmark(quiz_engine.get_quiz_dataset, forget_dataset, max_time=max_time)
+
+    engine = new_engine()
+    results['next_question'] = run_benchmark(engine.next_question, max_time=max_time)
+    options = []
+
+    def ask():
+        # A mazzo esaurito la prima chiamata lo rimescola e non restituisce domande
+        question = engine.next_question() or engine.next_question()
+        options[:] = question.options
+    results['answer'] = run_benchmark(lambda: engine.answer(options[0]), ask, max_time=max_time)
+    quiz_engine._progress_writer.flush()
+
+    category = engine.quiz_categories[0]
+    edits = iter(range(10 ** 9))
+
+    def save():
+        n = next(edits)
+        engine.save({'op': 'edit_quiz', 'category': category, 'index': 0,
+                     'quiz': {'kanji': '字', 'romaji': f"bench {n}", 'meaning': f"bench {n}", 'type': None}})
+    results['save'] = run_benchmark(save, max_time=max_time)
+    return results
+
+
+def traced_memory():
+    quiz_engine._progress_writer.flush()
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def bench_memory(size, categories, sessions):
+    """Byte del mazzo condiviso e byte per sessione: appena scelte tutte le categorie, a metà mazzo
+    (il punto in cui il progresso occupa di più) e in ripetizione dilazionata."""
+    build_deck(quiz_engine.DATA_FILE, size, categories)
+    remove_file(quiz_engine.SNAPSHOT_FILE)
+    remove_file(quiz_engine.JOURNAL_FILE)
+    forget_dataset()
+    results = {}
+    tracemalloc.start()
+    try:
+        start = traced_memory()
+        quiz_engine.get_quiz_dataset()
+        results['dataset'] = traced_memory() - start
+
+        for name in ('session_start', 'session_half_deck', 'session_review'):
+            engines = []
+            start = traced_memory()
+            for i in range(sessions):
+                engine = quiz_engine.QuizEngine(user_id=f"bench-{name}-{i}")
+                engine.load()
+                engine.select_categories(engine.quiz_categories)
+                if name == 'session_half_deck':
+                    for _ in range(size // 2):
+                        question = engine.next_question()
+                        engine.answer(random.choice(question.options))
+                elif name == 'session_review':
+                    engine.enable_review()
+                engines.append(engine)
+            results[name] = (traced_memory() - start) / sessions
+            del engines
+    finally:
+        tracemalloc.stop()
+    return results
+
+
+def print_memory(size, results):
+    print(f"\n--- memoria, mazzo da {size} quiz")
+    for name, value in results.items():
+        print(f"{name:<20}{value / 1024:>12.1f} KB")
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=APP_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(size, results):
+    print(f"\n--- mazzo da {size} quiz")
+    print(f"{'benchmark':<16}{'min':>14}{'mediana':>14}{'media':>14}{'stddev':>14}{'ops/s':>12}{'giri':>8}")
+    for name, stats in results.items():
+        print(f"{name:<16}" + "".join(f"{stats[key] * 1e6:>12.1f}µs" for key in ('min', 'median', 'mean', 'stddev'))
+              + f"{stats['ops'] or 0:>12.1f}{stats['rounds']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del motore di Kanji Quiz")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="quiz nei mazzi sintetici")
+    parser.add_argument('--categories', type=int, default=20, help="categorie nei mazzi sintetici")
+    parser.add_argument('--max-time', type=float, default=1.0, help="secondi di misura per benchmark")
+    parser.add_argument('--sessions', type=int, default=5, help="sessioni usate per misurare la memoria per sessione")
+    parser.add_argument('--json', help="file in cui salvare i risultati")
+    args = parser.parse_args()
+
+    # Nessuna compattazione in background durante le misure di salvataggio
+    quiz_engine.JOURNAL_COMPACT_THRESHOLD = float('inf')
+    workdir = tempfile.mkdtemp(prefix="kanji-quiz-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    results = {}
+    try:
+        for size in args.sizes:
+            forget_dataset()
+            results[size] = bench_deck(size, args.categories, args.max_time)
+            print_table(size, results[size])
+            results[size]['memory'] = bench_memory(size, args.categories, args.sessions)
+            print_memory(size, results[size]['memory'])
+        quiz_engine._progress_writer.flush()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'commit': git_commit(), 'timestamp': time.time(), 'config': vars(args),
+                       'benchmarks': results}, f, indent=2)
+        print(f"\nrisultati in {args.json}")
+
+
+if __name__ == "__main__":
+    main()
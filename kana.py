@@ -0,0 +1,45 @@
+"""Kanji Quiz kana
+
+Traslitterazione Hepburn di hiragana e katakana, condivisa dall'importazione dei dizionari (quiz_io)
+e dalla ricerca dell'editor (quiz_search).
+"""
+
+
+KANA_ROMAJI = dict(zip(
+    "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわゐゑをん"
+    "がぎぐげござじずぜぞだぢづでどばびぶべぼぱぴぷぺぽぁぃぅぇぉゎゔ",
+    "a i u e o ka ki ku ke ko sa shi su se so ta chi tsu te to na ni nu ne no ha hi fu he ho ma mi mu me mo "
+    "ya yu yo ra ri ru re ro wa i e o n ga gi gu ge go za ji zu ze zo da ji zu de do ba bi bu be bo "
+    "pa pi pu pe po a i u e o wa vu".split()))
+SMALL_Y = {'ゃ': 'ya', 'ゅ': 'yu', 'ょ': 'yo'}
+
+
+def kana_to_romaji(text):
+    """Traslitterazione Hepburn di hiragana e katakana; gli altri caratteri restano invariati."""
+    # Katakana -> hiragana: i due blocchi Unicode hanno lo stesso ordine
+    text = "".join(chr(ord(char) - 0x60) if 'ァ' <= char <= 'ヶ' else char for char in text)
+    result = []
+    double_next = False
+    i = 0
+    while i < len(text):
+        char = text[i]
+        i += 1
+        if char == 'っ':
+            double_next = True
+            continue
+        if char == 'ー':
+            syllable = next((c for c in reversed(result[-1]) if c in 'aeiou'), '') if result else ''
+        else:
+            syllable = KANA_ROMAJI.get(char, SMALL_Y.get(char, char))
+            # Le piccole ゃ/ゅ/ょ si uniscono alla sillaba prima del raddoppio di っ (いっしょ -> issho)
+            if i < len(text) and text[i] in SMALL_Y and syllable.endswith('i') and len(syllable) > 1:
+                small = SMALL_Y[text[i]]
+                syllable = syllable[:-1] + (small[1:] if syllable in ('shi', 'chi', 'ji') else small)
+                i += 1
+            elif char == 'ん' and i < len(text) and KANA_ROMAJI.get(text[i], ' ')[0] in 'aeiouy':
+                syllable = "n'"
+        if double_next:
+            syllable = ('t' if syllable.startswith('ch') else syllable[:1]) + syllable
+            double_next = False
+        result.append(syllable)
+    return "".join(result)
@@ -0,0 +1,303 @@
+"""Kanji Quiz load test
+
+Avvia l'app in un processo separato su un mazzo sintetico e la usa con N sessioni simulate
+via WebSocket (stesso protocollo del browser). Misura la latenza di avvio sessione, il tempo
+tra click e domanda successiva, RSS e CPU del server, e scrive i risultati in JSON.
+
+    python loadtest.py --sessions 50 --deck-size 10000 --rate 0.5 --duration 60 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from openpyxl import Workbook
+from tornado.websocket import websocket_connect
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_CODE = """
+import sys
+sys.path.insert(0, {app_dir!r})
+import App
+import tornado.ioloop
+import tornado.web
+
+App.metrics.enabled = True
+tornado.web.Application([(r"/metrics", App.MetricsHandler)]).listen({metrics_port})
+App.make_app(debug=False, async_sessions={async_sessions}).listen({port}, '127.0.0.1')
+tornado.ioloop.IOLoop.current().start()
+"""
+
+
+def build_deck(path, size, categories):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title="QuizData")
+    ws.append(['Kanji', 'Romaji', 'Significato', 'Categoria', 'Tipo'])
+    for i in range(size):
+        ws.append([chr(0x4E00 + i % 20000) + (chr(0x4E00 + i // 20000) if i >= 20000 else ''),
+                   f"romaji {i}", f"significato {i}", f"Categoria {i % categories:03d}",
+                   random.choice([None, 'v', 'a'])])
+    wb.save(path)
+
+
+def percentiles(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+    return {'count': len(ordered), 'mean': sum(ordered) / len(ordered), 'p50': rank(50),
+            'p95': rank(95), 'p99': rank(99), 'max': ordered[-1]}
+
+
+def find_buttons(spec, found):
+    if isinstance(spec, dict):
+        if spec.get('type') == 'buttons':
+            found.append(spec)
+        for value in spec.values():
+            find_buttons(value, found)
+    elif isinstance(spec, list):
+        for value in spec:
+            find_buttons(value, found)
+
+
+class SimulatedSession:
+    """Una sessione: sceglie le categorie, poi risponde alle domande al ritmo richiesto."""
+
+    def __init__(self, port, rate, deadline, categories_per_session, stats):
+        self.port = port
+        self.rate = rate
+        self.deadline = deadline
+        self.categories_per_session = categories_per_session
+        self.stats = stats
+        self.ws = None
+        self.question = None
+        self.received = None  # [messaggi, byte] ricevuti dall'ultima risposta inviata
+        self.sent = 0
+
+    async def run(self):
+        start = time.perf_counter()
+        try:
+            self.ws = await websocket_connect(f"ws://127.0.0.1:{self.port}/?app=index&session=NEW")
+            await self.wait_for_question()
+            self.stats['startup'].append(time.perf_counter() - start)
+            while time.monotonic() < self.deadline:
+                await asyncio.sleep(random.expovariate(self.rate))
+                button = random.choice(self.question['buttons'])
+                self.question = None
+                # Dopo la prima risposta arriva anche il resto della pagina iniziale: non si conta
+                if self.sent >= 2:
+                    self.stats['answer_messages'].append(self.received[0])
+                    self.stats['answer_bytes'].append(self.received[1])
+                self.received = [0, 0]
+                self.sent += 1
+                sent = time.perf_counter()
+                await self.ws.write_message(json.dumps(
+                    {'event': 'callback', 'task_id': self.callback_id, 'data': button['value']}))
+                await self.wait_for_question()
+                self.stats['answers'].append(time.perf_counter() - sent)
+        except Exception as e:
+            self.stats['errors'].append(f"{type(e).__name__}: {e}")
+        finally:
+            if self.ws is not None:
+                self.ws.close()
+
+    async def wait_for_question(self, timeout=30):
+        while self.question is None:
+            message = await asyncio.wait_for(self.ws.read_message(), timeout)
+            if message is None:
+                raise ConnectionError("sessione chiusa dal server")
+            if self.received is not None:
+                self.received[0] += 1
+                self.received[1] += len(message.encode('utf-8'))
+            await self.handle(json.loads(message))
+
+    async def handle(self, message):
+        command, spec = message.get('command'), message.get('spec') or {}
+        if command == 'input_group':
+            field = spec['inputs'][0]
+            if field['type'] == 'checkbox':
+                # Salta "Seleziona tutto" e sceglie alcune categorie a caso
+                options = [option['value'] for option in field['options'][1:]]
+                value = random.sample(options, min(self.categories_per_session, len(options)))
+            else:
+                value = ''
+            await self.ws.write_message(json.dumps(
+                {'event': 'from_submit', 'task_id': message['task_id'], 'data': {field['name']: value}}))
+        elif command == 'run_script' and spec.get('eval'):
+            await self.ws.write_message(json.dumps(
+                {'event': 'js_yield', 'task_id': message['task_id'], 'data': f"loadtest-{id(self)}"}))
+        elif command == 'output' and spec.get('scope') == '#pywebio-scope-question':
+            found = []
+            find_buttons(spec, found)
+            if found:
+                self.question = found[0]
+                self.callback_id = found[0]['callback_id']
+
+
+def read_process(pid):
+    """RSS in byte e tempo CPU in secondi dal /proc di Linux; None dove non disponibile."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f"/proc/{pid}/statm") as f:
+            rss_pages = int(f.read().split()[1])
+    except OSError:
+        return None, None
+    ticks = os.sysconf('SC_CLK_TCK')
+    return rss_pages * os.sysconf('SC_PAGE_SIZE'), (int(fields[11]) + int(fields[12])) / ticks
+
+
+async def monitor(pid, samples, stop):
+    while not stop.is_set():
+        rss, cpu = read_process(pid)
+        if rss is not None:
+            samples.append((time.monotonic(), rss, cpu))
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def drive(args, pid):
+    stats = {'startup': [], 'answers': [], 'answer_messages': [], 'answer_bytes': [], 'errors': []}
+    samples = []
+    stop = asyncio.Event()
+    monitor_task = asyncio.create_task(monitor(pid, samples, stop))
+    started = time.monotonic()
+    deadline = started + args.ramp + args.duration
+    tasks = []
+    for i in range(args.sessions):
+        session = SimulatedSession(args.port, args.rate, deadline, args.categories_per_session, stats)
+        tasks.append(asyncio.create_task(session.run()))
+        await asyncio.sleep(args.ramp / max(1, args.sessions))
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - started
+    stop.set()
+    await monitor_task
+    return stats, samples, elapsed
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/?test=1", timeout=1)
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("il server non ha risposto in tempo")
+
+
+def print_server_log(path, lines=30):
+    # La cartella di lavoro viene cancellata: in caso di errore si mostrano le ultime righe scritte dal server
+    try:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            tail = f.readlines()[-lines:]
+    except OSError:
+        return
+    if tail:
+        print(f"--- ultime righe di {os.path.basename(path)}", file=sys.stderr)
+        sys.stderr.writelines(tail)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=APP_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test per Kanji Quiz")
+    parser.add_argument('--sessions', type=int, default=20, help="sessioni simulate")
+    parser.add_argument('--deck-size', type=int, default=5000, help="quiz nel mazzo sintetico")
+    parser.add_argument('--categories', type=int, default=20, help="categorie nel mazzo sintetico")
+    parser.add_argument('--categories-per-session', type=int, default=3)
+    parser.add_argument('--rate', type=float, default=1.0, help="risposte al secondo per sessione")
+    parser.add_argument('--duration', type=float, default=30.0, help="secondi di carico dopo l'avvio delle sessioni")
+    parser.add_argument('--ramp', type=float, default=5.0, help="secondi in cui avviare tutte le sessioni")
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--async', dest='async_sessions', action='store_true', help="sessioni a coroutine sul server")
+    parser.add_argument('--output', default='loadtest_results.json')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="kanji-quiz-loadtest-")
+    server_log = os.path.join(workdir, "server.log")
+    server = None
+    try:
+        build_deck(os.path.join(workdir, "quiz_data.xlsx"), args.deck_size, args.categories)
+        shutil.copy(os.path.join(APP_DIR, "Logo.png"), workdir)
+        metrics_port = args.port + 1
+        code = SERVER_CODE.format(app_dir=APP_DIR, port=args.port, metrics_port=metrics_port,
+                                  async_sessions=args.async_sessions)
+        # Su file e non su una pipe: una pipe mai letta si riempie e blocca il server a metà misura
+        with open(server_log, "wb") as log:
+            server = subprocess.Popen([sys.executable, '-c', code], cwd=workdir, stdout=subprocess.DEVNULL, stderr=log)
+        wait_for_port(args.port)
+        _, cpu_before = read_process(server.pid)
+
+        stats, samples, elapsed = asyncio.run(drive(args, server.pid))
+
+        with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5) as response:
+            server_metrics = response.read().decode('utf-8')
+    except BaseException:
+        print_server_log(server_log)
+        raise
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    rss = [rss for _, rss, _ in samples]
+    cpu_used = samples[-1][2] - cpu_before if samples and cpu_before is not None else None
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'config': vars(args),
+        'elapsed_seconds': elapsed,
+        'session_startup_seconds': percentiles(stats['startup']),
+        'answer_round_trip_seconds': percentiles(stats['answers']),
+        'answers_per_second': len(stats['answers']) / elapsed if elapsed else None,
+        'messages_per_answer': percentiles(stats['answer_messages']),
+        'bytes_per_answer': percentiles(stats['answer_bytes']),
+        'errors': stats['errors'],
+        'server': {
+            'rss_max_bytes': max(rss) if rss else None,
+            'rss_end_bytes': rss[-1] if rss else None,
+            'cpu_seconds': cpu_used,
+            'cpu_percent': 100 * cpu_used / elapsed if cpu_used is not None and elapsed else None,
+        },
+        'server_metrics': server_metrics,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    rtt = results['answer_round_trip_seconds'] or {}
+    startup = results['session_startup_seconds'] or {}
+    print(f"sessioni: {len(stats['startup'])}/{args.sessions}, risposte: {len(stats['answers'])}, errori: {len(stats['errors'])}")
+    if startup:
+        print(f"avvio sessione p50/p95/p99: {startup['p50']:.3f}/{startup['p95']:.3f}/{startup['p99']:.3f} s")
+    if rtt:
+        print(f"risposta p50/p95/p99: {rtt['p50'] * 1000:.1f}/{rtt['p95'] * 1000:.1f}/{rtt['p99'] * 1000:.1f} ms")
+    if stats['answer_messages']:
+        print(f"per risposta: {results['messages_per_answer']['mean']:.1f} messaggi, "
+              f"{results['bytes_per_answer']['mean']:.0f} byte")
+    if rss:
+        print(f"RSS massimo server: {max(rss) / 2 ** 20:.1f} MB, CPU: {results['server']['cpu_percent'] or 0:.0f}%")
+    print(f"risultati in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1539 @@
+"""Kanji Quiz engine
+
+Dati condivisi, estrazione delle domande, distrattori, punteggio e persistenza, senza dipendenze
+dall'interfaccia: App.py è solo la vista PyWebIO sopra QuizEngine.
+"""
+from openpyxl import Workbook, load_workbook
+import atexit
+import bisect
+import contextlib
+import functools
+import hashlib
+import heapq
+import inspect
+import itertools
+import json
+import os
+import queue
+import random
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import traceback
+import unicodedata
+from array import array
+from collections import deque, namedtuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: niente processi multipli, basta il lock tra thread
+    fcntl = None
+
+
+DATA_FILE = "quiz_data.xlsx"
+SNAPSHOT_FILE = "quiz_data.snapshot"
+SNAPSHOT_MAGIC = b"KQSNAP"
+SNAPSHOT_SCHEMA = 1
+SNAPSHOT_HEADER = "<HI32s"  # versione dello schema, numero di righe, sha256 del file Excel
+JOURNAL_FILE = "quiz_data.journal"
+JOURNAL_PENDING_FILE = "quiz_data.journal.next"  # journal di una compattazione, finché il file Excel non è sostituito
+LOCK_FILE = "quiz_data.lock"
+JOURNAL_COMPACT_THRESHOLD = 500  # voci del journal oltre le quali il file Excel viene riscritto in background
+QUIZ_OPTIONS = 3  # risposte proposte per ogni domanda, compresa quella corretta
+PREFETCH_DEPTH = 2  # domande preparate in anticipo per sessione
+QUIZ_FIELDS = ('kanji', 'romaji', 'meaning', 'category', 'type')
+PROGRESS_DB = "quiz_progress.db"
+DAY = 24 * 60 * 60
+REVIEW_RELEARN_DELAY = 10 * 60  # secondi prima di riproporre un quiz sbagliato in ripetizione dilazionata
+RECENT_MISTAKES = 200  # errori tenuti in memoria per sessione; lo storico completo è nel database
+WRITE_BATCH_SIZE = 500
+WRITE_BATCH_DELAY = 1.0  # secondi di attesa massima per riempire un blocco di scritture
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_dataset_lock = threading.Lock()
+_dataset = None
+_journal_entries = 0
+_compaction_thread = None
+_category_renames = []  # (versione, vecchio nome, nuovo nome), per aggiornare le sessioni aperte
+_progress_db_lock = threading.Lock()
+_progress_db = None
+_shared_data_files = False  # True se altri processi possono modificare i file dei dati
+
+
+class Metrics:
+    """Contatori e istogrammi di latenza in formato testo Prometheus.
+    Finché sono disattivati ogni punto di misura costa un solo controllo su `enabled`."""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.types = {}
+        self.values = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, kind='counter', **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types[name] = kind
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            histogram[0][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+
+    def timed(self, name):
+        """Decoratore che misura la durata della funzione nell'istogramma `name`."""
+        def decorator(func):
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return await func(*args, **kwargs)
+                    start = time.perf_counter()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self.observe(name, time.perf_counter() - start)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.types):
+                lines.append(f"# TYPE {name} {self.types[name]}")
+                for (key_name, labels), value in sorted(self.values.items()):
+                    if key_name == name:
+                        label_text = ",".join(f'{label}="{label_value}"' for label, label_value in labels)
+                        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+            for name, (counts, total) in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{{le="{le}"}} {cumulative}')
+                lines.append(f"{name}_sum {total}")
+                lines.append(f"{name}_count {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+
+
+metrics = Metrics()
+
+
+def intern_text(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class QuizItem:
+    """Un quiz in sola lettura, condiviso da tutte le sessioni e dalle versioni dei dati che non lo modificano.
+    Niente dizionario per istanza e stringhe internate: categorie, tipi e testi ripetuti esistono una volta sola.
+    Si legge come attributo (quiz.kanji) oppure, come un dizionario, per chiave (quiz['kanji'])."""
+
+    __slots__ = QUIZ_FIELDS
+
+    def __init__(self, kanji, romaji, meaning, category, quiz_type):
+        self.kanji = intern_text(kanji)
+        self.romaji = intern_text(romaji)
+        self.meaning = intern_text(meaning)
+        self.category = intern_text(category)
+        self.type = intern_text(quiz_type)
+
+    @classmethod
+    def from_dict(cls, quiz, category):
+        return cls(quiz.get('kanji'), quiz.get('romaji'), quiz.get('meaning'), category, quiz.get('type'))
+
+    def __getitem__(self, field):
+        if field not in QUIZ_FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        return getattr(self, field) if field in QUIZ_FIELDS else default
+
+    def keys(self):
+        return QUIZ_FIELDS
+
+    def fields(self):
+        return [self.kanji, self.romaji, self.meaning, self.category, self.type]
+
+    def __eq__(self, other):
+        if not isinstance(other, QuizItem):
+            return NotImplemented
+        return self.fields() == other.fields()
+
+    def __hash__(self):
+        return hash((self.kanji, self.romaji, self.meaning, self.category, self.type))
+
+    def __repr__(self):
+        return f"QuizItem({', '.join(map(repr, self.fields()))})"
+
+
+class DistractorIndex:
+    """Indice delle risposte sbagliate: bucket per (categoria, tipo, ha kanji) e bucket globali per (tipo, ha kanji).
+    Le liste dei bucket sono condivise tra le versioni e crescono solo in coda: ogni versione ne vede i primi
+    `lengths[chiave]` elementi e ignora i quiz tolti fino alla sua epoca, quindi una modifica costa quanto
+    i quiz toccati e non quanto il mazzo."""
+
+    def __init__(self, quiz_data):
+        self.buckets = {}
+        for category, quizzes in quiz_data.items():
+            for quiz in quizzes:
+                for key in self._keys(category, quiz):
+                    self.buckets.setdefault(key, []).append(quiz)
+        self.lengths = {key: len(bucket) for key, bucket in self.buckets.items()}
+        self.dead = {}  # chiave -> quiz tolti ancora presenti nel bucket
+        self.removed = {}  # condiviso tra le versioni: id del quiz -> (epoca in cui è stato tolto, quiz)
+        self.epoch = 0
+        self.latest = [0]  # condiviso: epoca dell'ultima versione derivata
+
+    @staticmethod
+    def _keys(category, quiz):
+        kind = (quiz.type, bool(quiz.kanji))
+        return (category,) + kind, kind
+
+    def _visible(self, quiz):
+        removed = self.removed.get(id(quiz))
+        return removed is None or removed[0] > self.epoch
+
+    def sample(self, quiz, category, count, label):
+        """Estrae fino a `count` quiz con etichette diverse da quella di `quiz`, prima dalla sua categoria
+        e poi da tutte le altre. Se non ci sono abbastanza candidati ne restituisce meno."""
+        chosen = []
+        seen = {label(quiz)}
+        for key in self._keys(category, quiz):
+            self._draw(self.buckets.get(key, []), self.lengths.get(key, 0), count, label, seen, chosen)
+            if len(chosen) == count:
+                break
+        return chosen
+
+    def derive(self, removed=(), added=()):
+        """Nuovo indice con alcuni quiz tolti o aggiunti; copia solo i dizionari delle lunghezze, non i bucket."""
+        base = self if self.latest[0] == self.epoch else self._detached()
+        index = DistractorIndex({})
+        index.buckets = dict(base.buckets)
+        index.lengths = dict(base.lengths)
+        index.dead = dict(base.dead)
+        index.removed = base.removed
+        index.latest = base.latest
+        index.epoch = index.latest[0] = base.epoch + 1
+        touched = set()
+        for category, quiz in removed:
+            index.removed[id(quiz)] = (index.epoch, quiz)
+            for key in self._keys(category, quiz):
+                index.dead[key] = index.dead.get(key, 0) + 1
+                touched.add(key)
+        for category, quiz in added:
+            for key in self._keys(category, quiz):
+                bucket = index.buckets.get(key, [])
+                length = index.lengths.get(key, 0)
+                if len(bucket) != length:
+                    bucket = bucket[:length]  # una versione precedente ha già continuato il bucket
+                bucket.append(quiz)
+                index.buckets[key] = bucket
+                index.lengths[key] = length + 1
+        for key in touched:
+            # Bucket con più quiz tolti che validi: si ricopia, una volta ogni tanti quiz tolti
+            if index.dead[key] * 2 > index.lengths[key]:
+                bucket = [quiz for quiz in index.buckets[key][:index.lengths[key]] if index._visible(quiz)]
+                index.buckets[key] = bucket
+                index.lengths[key] = len(bucket)
+                del index.dead[key]
+        return index
+
+    def _detached(self):
+        # Copia indipendente di una versione che non è l'ultima: i quiz tolti dopo di lei riguardano un altro ramo
+        index = DistractorIndex({})
+        for key, bucket in self.buckets.items():
+            index.buckets[key] = [quiz for quiz in bucket[:self.lengths[key]] if self._visible(quiz)]
+        index.lengths = {key: len(bucket) for key, bucket in index.buckets.items()}
+        return index
+
+    def _draw(self, bucket, length, count, label, seen, chosen):
+        # Estrazioni casuali con scarto (tempo costante); scansione completa solo per bucket piccoli o pieni di doppioni
+        if length > 4 * count:
+            for _ in range(4 * count):
+                candidate = bucket[random.randrange(length)]
+                candidate_label = label(candidate)
+                if candidate_label not in seen and self._visible(candidate):
+                    seen.add(candidate_label)
+                    chosen.append(candidate)
+                    if len(chosen) == count:
+                        return
+        for position in random.sample(range(length), length):
+            candidate = bucket[position]
+            candidate_label = label(candidate)
+            if candidate_label not in seen and self._visible(candidate):
+                seen.add(candidate_label)
+                chosen.append(candidate)
+                if len(chosen) == count:
+                    return
+
+
+class DeckProgress:
+    """Permutazione mescolata pigramente degli indici di una categoria: le posizioni sotto `remaining`
+    sono i quiz non ancora mostrati. Finché sono poche, solo le posizioni scambiate vengono memorizzate
+    in un dizionario; quando superano un sedicesimo della categoria la permutazione passa in un array
+    da 4 byte per quiz, che da lì in poi occupa meno del dizionario."""
+
+    __slots__ = ('size', 'remaining', 'swaps', 'order')
+
+    def __init__(self, size):
+        self.size = size
+        self.remaining = size
+        self.swaps = {}
+        self.order = None
+
+    def draw(self):
+        position = random.randrange(self.remaining)
+        last = self.remaining - 1
+        order = self.order
+        if order is None:
+            quiz_index = self.swaps.get(position, position)
+            self.swaps[position] = self.swaps.pop(last, last)
+            if len(self.swaps) * 16 > self.size:
+                self._compact()
+        else:
+            quiz_index = order[position]
+            order[position] = order[last]
+        self.remaining = last
+        return quiz_index
+
+    def _compact(self):
+        order = array('I', range(self.size))
+        for position, quiz_index in self.swaps.items():
+            if position < self.size:
+                order[position] = quiz_index
+        self.order = order
+        self.swaps = {}
+
+    def undraw(self, quiz_index):
+        # Rimette tra i non mostrati un quiz appena estratto
+        if self.order is None:
+            self.swaps[self.remaining] = quiz_index
+        else:
+            self.order[self.remaining] = quiz_index
+        self.remaining += 1
+
+    def reset(self):
+        self.remaining = self.size
+        self.swaps = {}
+        self.order = None
+
+    def resize(self, size):
+        # I quiz aggiunti in coda alla categoria entrano tra quelli non ancora mostrati
+        if size < self.size:
+            self.size = size
+            self.reset()
+            return
+        if self.order is not None:
+            self.order.extend(range(self.size, size))
+        for quiz_index in range(self.size, size):
+            self.undraw(quiz_index)
+        self.size = size
+
+    def copy(self):
+        deck = DeckProgress(self.size)
+        deck.remaining = self.remaining
+        deck.swaps = dict(self.swaps)
+        deck.order = array('I', self.order) if self.order is not None else None
+        return deck
+
+    def state(self):
+        if self.order is None:
+            swaps = list(self.swaps.items())
+        else:
+            swaps = [(position, quiz_index) for position, quiz_index in enumerate(self.order[:self.remaining])
+                     if position != quiz_index]
+        return [self.size, self.remaining, swaps]
+
+    def discard(self, quiz_indices):
+        # Segna come mostrati i quiz indicati, anche oltre la dimensione attuale (aggiunti in seguito alla categoria).
+        # Ricostruisce la permutazione: O(size), usato solo alla ripresa di una sessione
+        self.resize(max(self.size, max(quiz_indices) + 1))
+        if self.order is None:
+            self._compact()
+        unseen = array('I', (quiz_index for quiz_index in self.order[:self.remaining] if quiz_index not in quiz_indices))
+        self.order[:len(unseen)] = unseen
+        self.remaining = len(unseen)
+
+
+class QuizScheduler:
+    """Estrae i quiz delle categorie selezionate senza ripetizioni e in tempo costante per estrazione.
+    La categoria è scelta con peso pari ai quiz che le restano; il progresso di ogni categoria
+    si conserva anche se la selezione cambia.
+    `served` raccoglie i quiz mostrati dall'ultimo salvataggio, così lo stato salvato si aggiorna per differenza;
+    è None quando il progresso è cambiato in altro modo (azzeramento, rinomina, ripresa) e va salvato per intero."""
+
+    def __init__(self):
+        self.progress = {}
+        self.categories = []
+        self.remaining = 0
+        self.total = 0
+        self.served = None
+
+    def select(self, categories, quiz_data):
+        self.categories = list(dict.fromkeys(categories))
+        for category in self.categories:
+            size = len(quiz_data.get(category, []))
+            if category in self.progress:
+                if size < self.progress[category].size:
+                    self.served = None  # La categoria è stata accorciata e il suo progresso azzerato
+                self.progress[category].resize(size)
+            else:
+                self.progress[category] = DeckProgress(size)
+        self._recount()
+
+    def _recount(self):
+        self.remaining = sum(self.progress[category].remaining for category in self.categories)
+        self.total = sum(self.progress[category].size for category in self.categories)
+
+    def draw(self):
+        """Restituisce (categoria, indice del quiz) oppure None se le categorie selezionate sono esaurite."""
+        if not self.remaining:
+            return None
+        pick = random.randrange(self.remaining)
+        for category in self.categories:
+            deck = self.progress[category]
+            if pick < deck.remaining:
+                break
+            pick -= deck.remaining
+        self.remaining -= 1
+        return category, deck.draw()
+
+    def serve(self, category, quiz_index):
+        # Il quiz estratto è stato mostrato: dal prossimo salvataggio non torna tra i non mostrati
+        if self.served is not None:
+            self.served.append((category, quiz_index))
+
+    def take_served(self):
+        """Quiz mostrati dall'ultima chiamata, da aggiungere allo stato salvato; None se va salvato state()."""
+        served, self.served = self.served, []
+        return served
+
+    def undraw(self, category, quiz_index):
+        self.progress[category].undraw(quiz_index)
+        if category in self.categories:
+            self.remaining += 1
+
+    def rename(self, old, new):
+        if old in self.progress and new not in self.progress:
+            self.progress[new] = self.progress.pop(old)
+        self.categories = [new if category == old else category for category in self.categories]
+        self.served = None
+
+    def reset(self):
+        for category in self.categories:
+            self.progress[category].reset()
+        self._recount()
+        self.served = None
+
+    def shown(self):
+        """Quiz già mostrati e quiz totali nelle categorie selezionate."""
+        return self.total - self.remaining, self.total
+
+    def state(self, undrawn=()):
+        """Progresso di ogni categoria in forma serializzabile in JSON. I quiz in `undrawn`, estratti
+        ma non ancora mostrati, risultano non mostrati; il progresso in memoria non cambia."""
+        progress = dict(self.progress)
+        for category, quiz_index in undrawn:
+            if progress[category] is self.progress[category]:
+                progress[category] = progress[category].copy()
+            progress[category].undraw(quiz_index)
+        return {category: deck.state() for category, deck in progress.items()}
+
+    def restore(self, state, served=()):
+        """Riprende il progresso salvato da state(), togliendo dai non mostrati i quiz `served` salvati dopo."""
+        self.progress = {}
+        for category, (size, remaining, swaps) in state.items():
+            deck = self.progress[category] = DeckProgress(size)
+            deck.remaining = remaining
+            deck.swaps = dict(swaps)
+        by_category = {}
+        for category, quiz_index in served:
+            by_category.setdefault(category, set()).add(quiz_index)
+        for category, quiz_indices in by_category.items():
+            self.progress.setdefault(category, DeckProgress(0)).discard(quiz_indices)
+        self.served = None
+
+
+def quiz_key(quiz):
+    # Chiave stabile tra riavvii e versioni dei dati, usata per lo stato salvato per utente
+    return "\x1f".join(str(quiz[field] or '') for field in ('kanji', 'romaji', 'meaning'))
+
+
+def duplicate_key(quiz):
+    # Come quiz_key, ma indifferente a spazi ai bordi e a varianti Unicode (NFKC, es. spazio ideografico):
+    # il mazzo esistente e le righe importate vengono confrontati con la stessa normalizzazione
+    return "\x1f".join(unicodedata.normalize('NFKC', str(quiz[field] or '')).strip()
+                        for field in ('kanji', 'romaji', 'meaning'))
+
+
+def progress_db():
+    """Connessione SQLite condivisa per i dati degli utenti; va usata tenendo _progress_db_lock."""
+    global _progress_db
+    if _progress_db is None:
+        connection = sqlite3.connect(PROGRESS_DB, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""CREATE TABLE IF NOT EXISTS review_state (
+            user_id TEXT NOT NULL, quiz_key TEXT NOT NULL, due REAL NOT NULL, interval REAL NOT NULL,
+            ease REAL NOT NULL, reps INTEGER NOT NULL, PRIMARY KEY (user_id, quiz_key))""")
+        connection.execute("""CREATE TABLE IF NOT EXISTS answers (
+            user_id TEXT NOT NULL, quiz_key TEXT NOT NULL, category TEXT NOT NULL, direction TEXT NOT NULL,
+            chosen TEXT, correct INTEGER NOT NULL, answered_at REAL NOT NULL)""")
+        connection.execute("CREATE INDEX IF NOT EXISTS answers_by_category ON answers (user_id, category, correct)")
+        connection.execute("CREATE INDEX IF NOT EXISTS answers_by_quiz ON answers (user_id, correct, quiz_key)")
+        connection.execute("""CREATE TABLE IF NOT EXISTS sessions (
+            user_id TEXT PRIMARY KEY, state TEXT NOT NULL, saved_at REAL NOT NULL)""")
+        # Progresso nel mazzo: stato completo più i quiz mostrati dopo, aggiunti a ogni salvataggio
+        connection.execute("""CREATE TABLE IF NOT EXISTS session_progress (
+            user_id TEXT PRIMARY KEY, progress TEXT NOT NULL)""")
+        connection.execute("""CREATE TABLE IF NOT EXISTS session_shown (
+            user_id TEXT NOT NULL, category TEXT NOT NULL, quiz_index INTEGER NOT NULL)""")
+        connection.execute("CREATE INDEX IF NOT EXISTS session_shown_by_user ON session_shown (user_id)")
+        connection.commit()
+        _progress_db = connection
+    return _progress_db
+
+
+class ProgressWriter:
+    """Scrive su SQLite a blocchi da un thread separato, così le risposte non aspettano il disco."""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def put(self, sql, params):
+        if self.thread is None:
+            with self.start_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, daemon=True)
+                    self.thread.start()
+        self.queue.put((sql, params))
+
+    def flush(self):
+        """Attende che le scritture già in coda siano sul database."""
+        if self.thread is None:
+            return
+        done = threading.Event()
+        self.queue.put((None, done))
+        done.wait()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + WRITE_BATCH_DELAY
+            while len(batch) < WRITE_BATCH_SIZE and batch[-1][0] is not None:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            with _progress_db_lock:
+                db = progress_db()
+                try:
+                    with db:
+                        for sql, rows in itertools.groupby(batch, key=lambda item: item[0]):
+                            if sql is not None:
+                                db.executemany(sql, [params for _, params in rows])
+                except sqlite3.Error:
+                    # Il blocco è stato annullato: si riprova una riga alla volta, così una riga non valida
+                    # non fa perdere quelle delle altre sessioni
+                    self._write_rows(db, batch)
+        except sqlite3.Error:
+            traceback.print_exc()
+        finally:
+            for sql, params in batch:
+                if sql is None:
+                    params.set()
+
+    def _write_rows(self, db, batch):
+        rows = [(sql, params) for sql, params in batch if sql is not None]
+        failed, error = 0, None
+        for sql, params in rows:
+            try:
+                with db:
+                    db.execute(sql, params)
+            except sqlite3.Error as row_error:
+                failed, error = failed + 1, row_error
+        if failed:
+            print(f"Progresso: {failed} righe su {len(rows)} non salvate ({error})", file=sys.stderr)
+
+
+def record_answer(user_id, quiz, category, direction, chosen, correct):
+    if user_id is None:
+        return  # Sessione senza id utente (QuizEngine() o browser che non l'ha fornito): niente storico
+    _progress_writer.put("INSERT INTO answers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (user_id, quiz_key(quiz), category, direction, chosen, int(correct), time.time()))
+
+
+def category_error_rates(user_id):
+    """(categoria, risposte, errori) per l'utente, calcolati da SQLite sull'indice per categoria."""
+    _progress_writer.flush()
+    with _progress_db_lock:
+        return progress_db().execute(
+            "SELECT category, COUNT(*), COUNT(*) - SUM(correct) FROM answers WHERE user_id = ? "
+            "GROUP BY category ORDER BY category", (user_id,)).fetchall()
+
+
+def most_missed(user_id, limit=10):
+    _progress_writer.flush()
+    with _progress_db_lock:
+        return progress_db().execute(
+            "SELECT quiz_key, COUNT(*) AS misses FROM answers WHERE user_id = ? AND correct = 0 "
+            "GROUP BY quiz_key ORDER BY misses DESC LIMIT ?", (user_id, limit)).fetchall()
+
+
+def load_review_states(user_id):
+    _progress_writer.flush()
+    with _progress_db_lock:
+        rows = progress_db().execute(
+            "SELECT quiz_key, due, interval, ease, reps FROM review_state WHERE user_id = ?", (user_id,)).fetchall()
+    return {row[0]: row[1:] for row in rows}
+
+
+def save_review_state(user_id, key, state):
+    if user_id is None:
+        return
+    _progress_writer.put("INSERT OR REPLACE INTO review_state VALUES (?, ?, ?, ?, ?, ?)", (user_id, key) + tuple(state))
+
+
+def save_session_state(user_id, state, shown=()):
+    """Con 'progress' lo stato sostituisce tutto il progresso salvato; senza, aggiorna punteggio e impostazioni
+    e aggiunge i quiz `shown` mostrati nel frattempo, con un costo che non dipende dalla dimensione del mazzo."""
+    if user_id is None:
+        return
+    state = dict(state)
+    progress = state.pop('progress', None)
+    _progress_writer.put("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                         (user_id, json.dumps(state, ensure_ascii=False, separators=(',', ':')), time.time()))
+    if progress is not None:
+        _progress_writer.put("INSERT OR REPLACE INTO session_progress VALUES (?, ?)",
+                             (user_id, json.dumps(progress, ensure_ascii=False, separators=(',', ':'))))
+        _progress_writer.put("DELETE FROM session_shown WHERE user_id = ?", (user_id,))
+    for category, quiz_index in shown:
+        _progress_writer.put("INSERT INTO session_shown VALUES (?, ?, ?)", (user_id, category, quiz_index))
+
+
+def load_session_state(user_id):
+    """Ultimo stato salvato della sessione dell'utente, scritto da qualsiasi processo; None se non c'è.
+    'shown' elenca i quiz mostrati dopo l'ultimo salvataggio completo di 'progress'."""
+    _progress_writer.flush()
+    with _progress_db_lock:
+        db = progress_db()
+        row = db.execute("SELECT state FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        if not row:
+            return None
+        progress = db.execute("SELECT progress FROM session_progress WHERE user_id = ?", (user_id,)).fetchone()
+        shown = db.execute("SELECT category, quiz_index FROM session_shown WHERE user_id = ? ORDER BY rowid",
+                           (user_id,)).fetchall()
+    state = json.loads(row[0])
+    if progress:
+        state['progress'] = json.loads(progress[0])
+    state['shown'] = shown
+    return state
+
+
+_progress_writer = ProgressWriter()
+atexit.register(_progress_writer.flush)
+
+
+def flush_progress():
+    """Attende che risposte, ripassi e sessioni in coda siano sul database, leggibili anche dagli altri processi."""
+    _progress_writer.flush()
+
+
+class ReviewQueue:
+    """Ripetizione dilazionata (SM-2): i quiz già ripassati stanno in un heap ordinato per scadenza, quindi
+    estrazione e riprogrammazione costano O(log n); quelli mai visti vengono dopo i ripassi scaduti,
+    nell'ordine delle categorie, da array compatti di indici. Lo stato dei quiz è salvato per utente e viene
+    letto solo quando la modalità viene attivata; la quiz_key si calcola solo per i quiz che ne hanno bisogno."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.states = None
+        self.quiz_data = {}
+        self.heap = []
+        self.unseen = []  # (categoria, indici in ordine inverso); la prossima categoria è l'ultima
+        self.pending = None
+        self.counter = itertools.count()
+
+    def select(self, categories, quiz_data):
+        if self.states is None:
+            self.states = load_review_states(self.user_id)
+        self.quiz_data = quiz_data
+        self.heap = []
+        self.unseen = []
+        for category in dict.fromkeys(categories):
+            unseen = array('I')
+            for quiz_index, quiz in enumerate(quiz_data.get(category, [])):
+                state = self.states.get(quiz_key(quiz)) if self.states else None
+                if state:
+                    self.heap.append((state[0], next(self.counter), category, quiz_index))
+                else:
+                    unseen.append(quiz_index)
+            unseen.reverse()
+            self.unseen.append((category, unseen))
+        self.unseen.reverse()
+        heapq.heapify(self.heap)
+        self.pending = None
+
+    def draw(self):
+        """Restituisce il ripasso scaduto da più tempo, altrimenti un quiz mai visto: un quiz sbagliato torna dopo
+        REVIEW_RELEARN_DELAY anche se restano quiz nuovi. None se nessun quiz è ancora scaduto, perché un ripasso
+        anticipato falserebbe gli intervalli."""
+        if self.pending is not None:
+            # Quiz saltato senza rispondere: torna dov'era
+            due, category, quiz_index = self.pending
+            if due:
+                heapq.heappush(self.heap, (due, next(self.counter), category, quiz_index))
+            else:
+                self.unseen.append((category, array('I', [quiz_index])))
+            self.pending = None
+        while self.unseen and not self.unseen[-1][1]:
+            self.unseen.pop()
+        if self.heap and self.heap[0][0] <= time.time():
+            due, _, category, quiz_index = heapq.heappop(self.heap)
+            self.pending = (due, category, quiz_index)
+        elif self.unseen:
+            category, unseen = self.unseen[-1]
+            self.pending = (0.0, category, unseen.pop())
+        else:
+            return None
+        return self.pending[1], self.pending[2]
+
+    def next_due(self):
+        # Scadenza del prossimo quiz da ripassare, None se non ce ne sono
+        return self.heap[0][0] if self.heap else None
+
+    def answer(self, correct):
+        if self.pending is None:
+            return
+        _, category, quiz_index = self.pending
+        self.pending = None
+        key = quiz_key(self.quiz_data[category][quiz_index])
+        due, interval, ease, reps = self.states.get(key, (0.0, 0.0, 2.5, 0))
+        quality = 4 if correct else 1
+        ease = max(1.3, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+        if correct:
+            reps += 1
+            interval = DAY if reps == 1 else 6 * DAY if reps == 2 else interval * ease
+        else:
+            reps = 0
+            interval = REVIEW_RELEARN_DELAY
+        state = (time.time() + interval, interval, ease, reps)
+        self.states[key] = state
+        heapq.heappush(self.heap, (state[0], next(self.counter), category, quiz_index))
+        save_review_state(self.user_id, key, state)
+
+
+class QuizDataset:
+    """Dati del quiz in sola lettura, caricati una volta e condivisi tra tutte le sessioni."""
+
+    def __init__(self, quiz_data, signature, version, loaded_version=None, distractors=None,
+                 checksum=None, journal_offset=None):
+        self.quiz_data = quiz_data
+        self.version = version
+        # Versione dell'ultima lettura completa dai file: le versioni derivate da modifiche in-app la ereditano
+        self.loaded_version = loaded_version if loaded_version is not None else version
+        self.quiz_categories = list(quiz_data.keys())
+        self.signature = signature
+        self.distractors = distractors if distractors is not None else DistractorIndex(quiz_data)
+        # Checksum del file Excel di base e byte del journal già applicati; offset None se il journal non si può seguire
+        self.checksum = checksum
+        self.journal_offset = journal_offset
+
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def data_file_signature():
+    return (file_signature(DATA_FILE), file_signature(JOURNAL_FILE))
+
+
+def create_empty_data_file():
+    wb = Workbook()
+    ws = wb.active
+    ws.title = 'Data'
+    headers = ['Kanji', 'Romanji', 'Significato', 'Categoria', 'Tipo (Verbo v /Aggettivo a)']
+    for idx, header in enumerate(headers, start=1):
+        ws.cell(row=1, column=idx, value=header)
+        ws.column_dimensions[chr(64 + idx)].width = 30
+    wb.save(DATA_FILE)
+    return {'Generale': []}
+
+
+@metrics.timed('kanji_quiz_xlsx_parse_seconds')
+def read_data_from_file():
+    # Lettura in streaming: niente modalità di modifica e nessun dizionario intermedio da ordinare
+    wb = load_workbook(DATA_FILE, read_only=True)
+    try:
+        quiz_data = {}
+        for row in wb.active.iter_rows(min_row=2, values_only=True):
+            kanji, romaji, meaning, category, quiz_type = (tuple(row) + (None,) * 5)[:5]
+            if quiz_type:
+                quiz_type = quiz_type.lower()
+            if not category or category == "Categoria":
+                category = "Generale"
+            quizzes = quiz_data.setdefault(category, [])
+            if kanji is None and romaji is None and meaning is None:
+                continue  # Riga vuota o segnaposto di una categoria senza quiz
+            quizzes.append(QuizItem(kanji, romaji, meaning, category, quiz_type))
+    finally:
+        wb.close()
+    return {category: quiz_data[category] for category in sorted(quiz_data)}
+
+
+def write_data_file(quiz_data, path=DATA_FILE):
+    """Riscrive il file Excel in modo atomico: file temporaneo e poi rename."""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title="QuizData")
+    ws.append(['Kanji', 'Romaji', 'Significato', 'Categoria', 'Tipo'])
+    for category, quizzes in quiz_data.items():
+        if not quizzes:
+            ws.append([None, None, None, category, None])
+        for quiz in quizzes:
+            ws.append([quiz.kanji, quiz.romaji, quiz.meaning, category, quiz.type])
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    wb.save(tmp_file)
+    os.replace(tmp_file, path)
+
+
+def data_file_checksum(path=DATA_FILE):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def compile_snapshot(quiz_data, checksum, path=SNAPSHOT_FILE):
+    """Scrive la versione compilata (colonnare, con gli offset delle categorie) accanto al file Excel."""
+    columns = {'categories': list(quiz_data.keys()), 'offsets': [0],
+               'kanji': [], 'romaji': [], 'meaning': [], 'type': []}
+    for quizzes in quiz_data.values():
+        for quiz in quizzes:
+            for key in ('kanji', 'romaji', 'meaning', 'type'):
+                columns[key].append(getattr(quiz, key))
+        columns['offsets'].append(len(columns['kanji']))
+    payload = json.dumps(columns, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    header = SNAPSHOT_MAGIC + struct.pack(SNAPSHOT_HEADER, SNAPSHOT_SCHEMA, len(columns['kanji']), checksum)
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(header + payload)
+    os.replace(tmp_file, path)
+
+
+def read_snapshot(checksum):
+    """Carica la versione compilata con una sola lettura; None se manca o non corrisponde al file Excel."""
+    try:
+        with open(SNAPSHOT_FILE, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    header_size = len(SNAPSHOT_MAGIC) + struct.calcsize(SNAPSHOT_HEADER)
+    if len(data) < header_size or not data.startswith(SNAPSHOT_MAGIC):
+        return None
+    schema, count, source_checksum = struct.unpack_from(SNAPSHOT_HEADER, data, len(SNAPSHOT_MAGIC))
+    if schema != SNAPSHOT_SCHEMA or source_checksum != checksum:
+        return None
+    columns = json.loads(memoryview(data)[header_size:].tobytes())
+    kanji, romaji, meaning, types = columns['kanji'], columns['romaji'], columns['meaning'], columns['type']
+    offsets = columns['offsets']
+    quiz_data = {}
+    for i, category in enumerate(columns['categories']):
+        category = sys.intern(category)
+        quiz_data[category] = [QuizItem(kanji[j], romaji[j], meaning[j], category, types[j])
+                               for j in range(offsets[i], offsets[i + 1])]
+    return quiz_data if offsets[-1] == count else None
+
+
+def check_journal_entry(quiz_data, entry):
+    """ValueError se la voce non si può applicare a quiz_data, per esempio una rinomina su una categoria
+    creata nel frattempo da un'altra sessione: commit_edit la controlla sull'ultima versione, prima del journal."""
+    op, category = entry['op'], entry['category']
+    if op == 'add_category':
+        if category in quiz_data:
+            raise ValueError(f"La categoria esiste già: {category}")
+    elif category not in quiz_data:
+        raise ValueError(f"La categoria non esiste: {category}")
+    elif op == 'rename_category' and entry['name'] in quiz_data:
+        raise ValueError(f"La categoria esiste già: {entry['name']}")
+
+
+def apply_journal_entry(quiz_data, entry):
+    """Applica a quiz_data una voce del journal. Le liste delle categorie toccate vengono modificate sul posto:
+    chi lavora su dati condivisi deve passarne una copia (vedi commit_edit)."""
+    check_journal_entry(quiz_data, entry)
+    op, category = entry['op'], entry['category']
+    if op == 'add_category':
+        quiz_data[category] = []
+    elif op == 'rename_category':
+        name = entry['name']
+        quiz_data[name] = [QuizItem(quiz.kanji, quiz.romaji, quiz.meaning, name, quiz.type) for quiz in quiz_data.pop(category)]
+        renamed = {key: quiz_data[key] for key in sorted(quiz_data)}
+        quiz_data.clear()
+        quiz_data.update(renamed)
+    elif op == 'add_quiz':
+        quiz_data[category].append(QuizItem.from_dict(entry['quiz'], category))
+    elif op == 'edit_quiz':
+        quiz_data[category][entry['index']] = QuizItem.from_dict(entry['quiz'], category)
+    else:
+        raise ValueError(f"Operazione sconosciuta nel journal: {op}")
+
+
+def read_journal(checksum, offset=0):
+    """Voci complete del journal dal byte `offset` in poi e offset da cui riprendere la lettura.
+    Dall'inizio del file controlla anche l'intestazione: un journal scritto su un'altra versione
+    del file Excel è già stato compattato, e si restituiscono nessuna voce e offset None."""
+    entries = []
+    header = offset == 0
+    try:
+        with open(JOURNAL_FILE, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # Ultima riga incompleta dopo un'interruzione
+                if not line.endswith(b"\n"):
+                    break  # Riga ancora in scrittura da parte di un altro processo
+                if header:
+                    if record.get('base') != checksum.hex():
+                        return [], None
+                    header = False
+                else:
+                    entries.append(record)
+                offset += len(line)
+    except FileNotFoundError:
+        pass
+    return entries, offset
+
+
+def replay_journal(quiz_data, checksum):
+    """Riapplica il journal sopra i dati di base; restituisce il numero di voci lette e l'offset raggiunto."""
+    entries, offset = read_journal(checksum)
+    for entry in entries:
+        apply_journal_entry(quiz_data, entry)
+    return len(entries), offset
+
+
+def append_journal(entry):
+    new_journal = not os.path.isfile(JOURNAL_FILE)
+    with open(JOURNAL_FILE, "a", encoding="utf-8") as f:
+        if new_journal:
+            f.write(json.dumps({'base': data_file_checksum().hex()}) + "\n")
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+@metrics.timed('kanji_quiz_dataset_load_seconds')
+def load_quiz_files():
+    """Dati di base più journal; restituisce anche il checksum del file Excel e l'offset raggiunto nel journal."""
+    global _journal_entries
+    checksum = data_file_checksum()
+    _recover_pending_journal(checksum)
+    quiz_data = read_snapshot(checksum)
+    if quiz_data is None:
+        quiz_data = read_data_from_file()
+        try:
+            compile_snapshot(quiz_data, checksum)
+        except OSError:
+            pass  # Senza permessi di scrittura si continua a leggere il file Excel
+    _journal_entries, offset = replay_journal(quiz_data, checksum)
+    return quiz_data, checksum, offset
+
+
+def _current_dataset_locked():
+    global _dataset
+    signature = data_file_signature()
+    if _dataset is None or _dataset.signature != signature:
+        if _dataset is not None and _dataset.signature[0] == signature[0] and signature[0] is not None:
+            # Solo il journal è cambiato: si applicano le voci scritte da altri processi
+            dataset = _follow_journal_locked(_dataset, signature)
+            if dataset is not None:
+                _dataset = dataset
+                return _dataset
+        if signature[0] is None:
+            quiz_data = create_empty_data_file()
+            signature = data_file_signature()
+            checksum, offset = data_file_checksum(), 0
+        else:
+            quiz_data, checksum, offset = load_quiz_files()
+        metrics.inc('kanji_quiz_dataset_reloads_total')
+        _dataset = QuizDataset(quiz_data, signature, _next_version(), checksum=checksum, journal_offset=offset)
+    return _dataset
+
+
+def _follow_journal_locked(dataset, signature):
+    """Nuova versione con le voci aggiunte al journal dopo `dataset`. Il file Excel è lo stesso, quindi le posizioni
+    dei quiz non cambiano e le sessioni aperte conservano il progresso. None se il journal non continua
+    quello già letto (sostituito o scritto su un'altra base): allora serve una rilettura completa."""
+    global _journal_entries
+    offset = dataset.journal_offset
+    if offset is None or signature[1] is None or signature[1][1] < offset:
+        return None
+    entries, offset = read_journal(dataset.checksum, offset)
+    if offset is None:
+        return None
+    _journal_entries += len(entries)
+    metrics.inc('kanji_quiz_journal_follows_total')
+    return _apply_entries_locked(dataset, entries, signature, offset)
+
+
+def _apply_entries_locked(dataset, entries, signature, journal_offset):
+    """Versione successiva di `dataset` con le voci del journal applicate. Le versioni già pubblicate non vengono
+    mai modificate: si copiano solo il dizionario delle categorie e le liste toccate, e l'indice dei distrattori
+    aggiorna solo i quiz tolti o aggiunti."""
+    quiz_data = dict(dataset.quiz_data)
+    copied = set()
+    removed, added = [], []
+    version = _next_version()
+    for entry in entries:
+        check_journal_entry(quiz_data, entry)
+        op, category = entry['op'], entry['category']
+        if op in ('add_quiz', 'edit_quiz') and category not in copied:
+            quiz_data[category] = list(quiz_data[category])
+            copied.add(category)
+        if op == 'edit_quiz':
+            removed.append((category, quiz_data[category][entry['index']]))
+        elif op == 'rename_category':
+            removed.extend((category, quiz) for quiz in quiz_data[category])
+        apply_journal_entry(quiz_data, entry)
+        if op == 'add_quiz':
+            added.append((category, quiz_data[category][-1]))
+        elif op == 'edit_quiz':
+            added.append((category, quiz_data[category][entry['index']]))
+        elif op == 'rename_category':
+            added.extend((entry['name'], quiz) for quiz in quiz_data[entry['name']])
+            copied.add(entry['name'])
+            _category_renames.append((version, category, entry['name']))
+        elif op == 'add_category':
+            copied.add(category)
+    return QuizDataset(quiz_data, signature, version, dataset.loaded_version, dataset.distractors.derive(removed, added),
+                       dataset.checksum, journal_offset)
+
+
+def _next_version():
+    return _dataset.version + 1 if _dataset is not None else 1
+
+
+def current_quiz_dataset():
+    """Versione pubblicata più recente, senza lock né accessi al disco: è il percorso usato a ogni domanda.
+    Con più processi controlla anche mtime e dimensione dei file, per vedere le modifiche fatte dagli altri."""
+    if _shared_data_files and _dataset is not None:
+        return get_quiz_dataset()
+    return _dataset
+
+
+def share_data_files():
+    """Da chiamare in ogni processo quando più processi servono gli stessi file dei dati."""
+    global _shared_data_files
+    _shared_data_files = True
+
+
+@contextlib.contextmanager
+def data_files_lock():
+    """Lock esclusivo sui file dei dati tra processi diversi (su Windows solo quello tra thread)."""
+    with _dataset_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(LOCK_FILE, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def renamed_categories(since_version, until_version):
+    return [(old, new) for version, old, new in _category_renames if since_version < version <= until_version]
+
+
+def get_quiz_dataset():
+    """Restituisce i dati condivisi, rileggendo i file solo se mtime o dimensione sono cambiati."""
+    dataset = _dataset
+    if dataset is not None and dataset.signature == data_file_signature():
+        return dataset
+    with _dataset_lock:
+        return _current_dataset_locked()
+
+
+@metrics.timed('kanji_quiz_save_seconds')
+def commit_edit(entry):
+    """Unico punto di scrittura: registra una modifica nel journal (append + fsync) e pubblica una nuova versione,
+    con un costo che dipende dalla categoria toccata e non dalla dimensione del mazzo."""
+    global _dataset, _journal_entries
+    with data_files_lock():
+        dataset = _current_dataset_locked()
+        renames = len(_category_renames)
+        # La voce viene applicata prima di scriverla: una voce non valida non arriva nel journal
+        new_dataset = _apply_entries_locked(dataset, [entry], None, None)
+        try:
+            append_journal(entry)
+        except BaseException:
+            del _category_renames[renames:]
+            raise
+        metrics.inc('kanji_quiz_saves_total')
+        _journal_entries += 1
+        new_dataset.signature = data_file_signature()
+        new_dataset.journal_offset = os.path.getsize(JOURNAL_FILE)
+        _dataset = new_dataset
+        if _journal_entries >= JOURNAL_COMPACT_THRESHOLD:
+            start_background_compaction()
+        return _dataset
+
+
+def _write_data_files_locked(quiz_data):
+    """Riscrive file Excel, versione compilata e un journal vuoto; va chiamata tenendo data_files_lock.
+    Restituisce la firma dei file, il nuovo checksum del file Excel e l'offset della fine del journal."""
+    global _journal_entries
+    write_data_file(quiz_data)
+    checksum = data_file_checksum()
+    try:
+        compile_snapshot(quiz_data, checksum)
+    except OSError:
+        pass
+    # Se il processo si interrompe prima di questo punto, il journal resta legato
+    # alla vecchia versione del file Excel e non viene riapplicato due volte
+    offset = _replace_journal(checksum)
+    _journal_entries = 0
+    return data_file_signature(), checksum, offset
+
+
+def _replace_journal(checksum, entries=b"", path=JOURNAL_FILE):
+    # Nuovo journal legato al file Excel `checksum`, con le righe `entries` già scritte; restituisce la sua lunghezza
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    data = (json.dumps({'base': checksum.hex()}) + "\n").encode("utf-8") + entries
+    with open(tmp_file, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+    return len(data)
+
+
+def _recover_pending_journal(checksum):
+    # Compattazione interrotta dopo aver sostituito il file Excel: il journal preparato contiene le righe
+    # arrivate durante la riscrittura, quello vecchio è legato al file Excel precedente
+    try:
+        with open(JOURNAL_PENDING_FILE, "rb") as f:
+            header = json.loads(f.readline() or b"{}")
+    except FileNotFoundError:
+        return
+    except ValueError:
+        header = {}
+    if header.get('base') == checksum.hex():
+        os.replace(JOURNAL_PENDING_FILE, JOURNAL_FILE)
+    else:
+        os.remove(JOURNAL_PENDING_FILE)
+
+
+@metrics.timed('kanji_quiz_compaction_seconds')
+def compact_journal():
+    """Riporta nel file Excel le modifiche del journal e lo svuota. File Excel e versione compilata si scrivono
+    fuori dal lock, dalla versione letta all'inizio, così le modifiche non aspettano la riscrittura; sotto il lock
+    si sostituiscono i file e il journal riparte con le sole righe scritte nel frattempo."""
+    global _journal_entries
+    with data_files_lock():
+        dataset = _current_dataset_locked()
+        if not _journal_entries or dataset.journal_offset is None:
+            return
+    data_file, snapshot_file = f"{DATA_FILE}.{os.getpid()}.compact", f"{SNAPSHOT_FILE}.{os.getpid()}.compact"
+    write_data_file(dataset.quiz_data, data_file)
+    checksum = data_file_checksum(data_file)
+    try:
+        compile_snapshot(dataset.quiz_data, checksum, snapshot_file)
+    except OSError:
+        snapshot_file = None
+    with data_files_lock():
+        current = _current_dataset_locked()
+        if current.checksum != dataset.checksum or current.journal_offset is None:
+            # File Excel riscritto nel frattempo (importazione o compattazione di un altro processo)
+            for path in (data_file, snapshot_file):
+                if path is not None:
+                    os.remove(path)
+            return
+        with open(JOURNAL_FILE, "rb") as f:
+            f.seek(dataset.journal_offset)
+            entries = f.read(current.journal_offset - dataset.journal_offset)
+        # Il nuovo journal è su disco prima del file Excel: se il processo si interrompe tra i due rename,
+        # il caricamento successivo lo trova accanto al file Excel nuovo (_recover_pending_journal)
+        offset = _replace_journal(checksum, entries, JOURNAL_PENDING_FILE)
+        os.replace(data_file, DATA_FILE)
+        if snapshot_file is not None:
+            os.replace(snapshot_file, SNAPSHOT_FILE)
+        os.replace(JOURNAL_PENDING_FILE, JOURNAL_FILE)
+        current.signature, current.checksum, current.journal_offset = data_file_signature(), checksum, offset
+        _journal_entries = entries.count(b"\n")
+
+
+@metrics.timed('kanji_quiz_bulk_import_seconds')
+def commit_bulk(quizzes):
+    """Aggiunge in blocco i quiz prodotti dall'iterabile `quizzes` (dizionari con category, kanji, romaji,
+    meaning, type), saltando quelli con la stessa duplicate_key (kanji, romaji, significato) di un quiz già presente.
+    L'iterabile viene consumato una volta sola e i file vengono riscritti una volta alla fine.
+    Restituisce (aggiunti, doppioni)."""
+    global _dataset
+    with data_files_lock():
+        dataset = _current_dataset_locked()
+        quiz_data = dict(dataset.quiz_data)
+        seen = {duplicate_key(quiz) for items in quiz_data.values() for quiz in items}
+        copied = set()
+        added = duplicates = 0
+        for quiz in quizzes:
+            category = quiz['category']
+            key = duplicate_key(quiz)
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            if category not in copied:
+                quiz_data[category] = list(quiz_data.get(category, []))
+                copied.add(category)
+            quiz_data[category].append(QuizItem(quiz['kanji'], quiz['romaji'], quiz['meaning'], category, quiz['type']))
+            added += 1
+        if not added:
+            return added, duplicates
+        quiz_data = {category: quiz_data[category] for category in sorted(quiz_data)}
+        signature, checksum, offset = _write_data_files_locked(quiz_data)
+        metrics.inc('kanji_quiz_saves_total')
+        # I quiz esistenti non cambiano posizione: le sessioni aperte conservano il loro progresso
+        _dataset = QuizDataset(quiz_data, signature, _next_version(), dataset.loaded_version,
+                               checksum=checksum, journal_offset=offset)
+        return added, duplicates
+
+
+def start_background_compaction():
+    global _compaction_thread
+    if _compaction_thread is None or not _compaction_thread.is_alive():
+        _compaction_thread = threading.Thread(target=compact_journal, daemon=True)
+        _compaction_thread.start()
+
+
+# `rendered` è il contenuto preparato dalla funzione `render` della vista, se impostata
+Question = namedtuple('Question', ['category', 'quiz', 'direction', 'prompt', 'options', 'correct_answer', 'rendered'],
+                      defaults=(None,))
+AnswerResult = namedtuple('AnswerResult', ['correct', 'correct_answer', 'question_text', 'romaji'])
+Mistake = namedtuple('Mistake', ['seq', 'quiz', 'direction', 'given_answer'])
+
+
+def format_option(quiz, direction):
+    type_label = f" ({quiz.type})" if quiz.type else ""
+    if direction == 'kanji to meaning':
+        return quiz.meaning + type_label
+    return (quiz.kanji if quiz.kanji else quiz.romaji) + type_label
+
+
+def format_question(quiz, direction):
+    if direction == 'kanji to meaning':
+        return f"Quale è il significato di questo kanji/katakana: {quiz.kanji if quiz.kanji else quiz.romaji}?"
+    return f"Quale kanji/katakana corrisponde a questo significato: {quiz.meaning}?"
+
+
+def describe_mistake(quiz, direction):
+    """Domanda e risposta corretta di un errore come appaiono nel riepilogo, con il romaji."""
+    question, correct_answer = format_question(quiz, direction), format_option(quiz, direction)
+    if direction == 'kanji to meaning':
+        return f"{question} ({quiz.romaji})", correct_answer
+    return question, f"{correct_answer} ({quiz.romaji})"
+
+
+def invalidates_prefetch(method):
+    """Per i metodi di QuizEngine che cambiano ciò da cui dipendono le domande preparate: le scarta e tiene
+    il lock per tutta la modifica, così un prefetch() in un altro thread non lavora su uno stato a metà."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.prefetch_lock:
+            self.invalidate_prefetch()
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class QuizEngine:
+    """Stato di una sessione di quiz: categorie selezionate, estrazione delle domande, punteggio ed errori recenti.
+    Non produce output: restituisce domande e risultati, la vista decide come mostrarli."""
+
+    def __init__(self, user_id=None):
+        self.dataset = None
+        self.quiz_categories = []
+        self.quiz_data = {}
+        self.current_category = ""
+        self.current_quiz = None
+        self.question = None
+        self.correct_answers = 0
+        self.total_questions = 0
+        self.scheduler = QuizScheduler()
+        self.review_queue = None
+        self.user_id = user_id
+        self.quiz_direction = 'kanji to meaning'
+        self.selected_categories = []
+        self.num_options = QUIZ_OPTIONS
+        self.completed = False
+        self.review_due = None
+        self.wrong_answers = deque(maxlen=RECENT_MISTAKES)
+        self.mistake_seq = 0
+        self.render = None
+        # Domande già estratte e preparate ma non ancora mostrate: (categoria, indice del quiz, Question)
+        self.prefetched = deque()
+        self.prefetch_lock = threading.RLock()
+
+    def load(self):
+        self.use_dataset(get_quiz_dataset())
+
+    @invalidates_prefetch
+    def use_dataset(self, dataset):
+        # I dati sono condivisi: la sessione tiene solo un riferimento alla versione corrente
+        if self.dataset is not None:
+            if dataset.loaded_version != self.dataset.loaded_version:
+                # Dati riletti dai file: le posizioni dei quiz nelle categorie possono essere cambiate
+                self.scheduler = QuizScheduler()
+            for old, new in renamed_categories(self.dataset.version, dataset.version):
+                self.selected_categories = [new if category == old else category for category in self.selected_categories]
+                if self.current_category == old:
+                    self.current_category = new
+                self.scheduler.rename(old, new)
+        self.dataset = dataset
+        self.quiz_data = dataset.quiz_data
+        self.quiz_categories = dataset.quiz_categories
+        self.scheduler.select(self.selected_categories, self.quiz_data)
+        if self.review_queue is not None:
+            self.review_queue.select(self.selected_categories, self.quiz_data)
+
+    def refresh_dataset(self):
+        # Passa all'ultima versione pubblicata, senza rileggere i file
+        dataset = current_quiz_dataset()
+        if dataset is not None and dataset is not self.dataset:
+            self.use_dataset(dataset)
+
+    def save(self, entry):
+        """Registra una modifica ai dati condivisi e passa alla nuova versione; gli errori di scrittura risalgono al chiamante."""
+        self.use_dataset(commit_edit(entry))
+
+    @invalidates_prefetch
+    def select_categories(self, categories):
+        self.selected_categories = list(categories)
+        self.scheduler.select(self.selected_categories, self.quiz_data)
+        if self.review_queue is not None:
+            self.review_queue.select(self.selected_categories, self.quiz_data)
+        if self.selected_categories:
+            self.current_category = random.choice(self.selected_categories)
+
+    @invalidates_prefetch
+    def enable_review(self):
+        self.review_queue = ReviewQueue(self.user_id)
+        self.review_queue.select(self.selected_categories, self.quiz_data)
+
+    @invalidates_prefetch
+    def disable_review(self):
+        self.review_queue = None
+
+    @invalidates_prefetch
+    def switch_direction(self):
+        if self.quiz_direction == 'kanji to meaning':
+            self.quiz_direction = 'meaning to kanji'
+        else:
+            self.quiz_direction = 'kanji to meaning'
+
+    def draw(self):
+        """Estrae il prossimo quiz; None se non ce ne sono. Quando le categorie selezionate sono esaurite
+        il mazzo viene rimescolato e `completed` diventa True. In ripetizione dilazionata, se nessun quiz
+        è ancora scaduto, `review_due` è l'ora del prossimo ripasso."""
+        self.completed = False
+        self.review_due = None
+        if not self.selected_categories:
+            return None
+        if self.review_queue is not None:
+            drawn = self.review_queue.draw()
+            if drawn is None:
+                self.review_due = self.review_queue.next_due()
+        else:
+            drawn = self.scheduler.draw()
+            if drawn is None:
+                self.completed = True
+                self.scheduler.reset()
+            else:
+                self.scheduler.serve(*drawn)
+        if drawn is None:
+            return None
+        self.current_category, quiz_index = drawn
+        return self.quiz_data[self.current_category][quiz_index]
+
+    def next_question(self, refresh=True):
+        """Restituisce la prossima domanda con le opzioni già mescolate; None se non ci sono quiz da proporre.
+        Se prefetch() ne ha preparata una ancora valida costa solo un'estrazione dalla coda.
+        `refresh=False` salta il controllo dei file dei dati, se il chiamante l'ha appena fatto."""
+        if refresh:
+            self.refresh_dataset()
+        with self.prefetch_lock:
+            if self.prefetched:
+                category, quiz_index, question = self.prefetched.popleft()
+                self.scheduler.serve(category, quiz_index)
+                self.completed = False
+                self.current_category = question.category
+                metrics.inc('kanji_quiz_prefetch_total', result='hit')
+            else:
+                quiz = self.draw()
+                if quiz is None:
+                    return None
+                question = self.prepare_question(self.current_category, quiz)
+                metrics.inc('kanji_quiz_prefetch_total', result='miss')
+            self.current_quiz = question.quiz
+            self.question = question
+        metrics.inc('kanji_quiz_questions_served_total')
+        return question
+
+    def prepare_question(self, category, quiz):
+        option_label = self.option_label
+        wrong_answers = self.dataset.distractors.sample(quiz, category, self.num_options - 1, option_label)
+        options = [option_label(other) for other in [quiz] + wrong_answers]
+        random.shuffle(options)
+        if self.quiz_direction == 'kanji to meaning':
+            prompt = quiz.kanji if quiz.kanji else quiz.romaji
+        else:
+            prompt = quiz.meaning
+        question = Question(category, quiz, self.quiz_direction, prompt, options, option_label(quiz))
+        if self.render is not None:
+            question = question._replace(rendered=self.render(question))
+        return question
+
+    def prefetch(self, depth=PREFETCH_DEPTH):
+        """Prepara in anticipo fino a `depth` domande; va chiamata dopo aver mostrato quella corrente.
+        In ripetizione dilazionata il quiz successivo dipende dalla risposta, quindi non si prepara nulla;
+        a fine mazzo si preparano solo i quiz rimasti e il rimescolamento resta a next_question."""
+        with self.prefetch_lock:
+            while len(self.prefetched) < depth and self.review_queue is None and self.scheduler.remaining:
+                category, quiz_index = self.scheduler.draw()
+                question = self.prepare_question(category, self.quiz_data[category][quiz_index])
+                self.prefetched.append((category, quiz_index, question))
+
+    def invalidate_prefetch(self):
+        """Scarta le domande preparate rimettendo i loro quiz nel mazzo. La vista la chiama, tenendo
+        prefetch_lock, quando cambia qualcosa da cui dipende il suo `render`."""
+        with self.prefetch_lock:
+            while self.prefetched:
+                category, quiz_index, _ = self.prefetched.pop()
+                self.scheduler.undraw(category, quiz_index)
+
+    def option_label(self, quiz):
+        return format_option(quiz, self.quiz_direction)
+
+    def get_correct_answer(self):
+        return format_option(self.current_quiz, self.quiz_direction)
+
+    def get_question_text(self):
+        return format_question(self.current_quiz, self.quiz_direction)
+
+    def answer(self, selected_option):
+        """Valuta la risposta alla domanda corrente, aggiorna punteggio, errori recenti e storico."""
+        correct_answer = self.get_correct_answer()
+        question_text = self.get_question_text()
+        romaji = self.current_quiz.romaji
+        correct = selected_option == correct_answer
+        if correct:
+            self.correct_answers += 1
+        else:
+            # Solo riferimenti al quiz condiviso: i testi per il riepilogo si compongono con describe_mistake
+            self.mistake_seq += 1
+            self.wrong_answers.append(Mistake(self.mistake_seq, self.current_quiz, self.quiz_direction, selected_option))
+        record_answer(self.user_id, self.current_quiz, self.current_category, self.quiz_direction, selected_option, correct)
+        metrics.inc('kanji_quiz_answers_total', result='correct' if correct else 'wrong')
+        if self.review_queue is not None:
+            self.review_queue.answer(correct)
+        self.total_questions += 1
+        return AnswerResult(correct, correct_answer, question_text, romaji)
+
+    def score(self):
+        """Risposte corrette e risposte totali."""
+        return self.correct_answers, self.total_questions
+
+    def reset_score(self):
+        self.correct_answers = 0
+        self.total_questions = 0
+        self.wrong_answers = deque(maxlen=RECENT_MISTAKES)
+
+    def session_state(self, progress=True):
+        """Stato della sessione serializzabile in JSON, per riprenderla in un altro processo o dopo un riavvio.
+        Con `progress=False` manca il progresso nel mazzo, l'unica parte che cresce con le categorie."""
+        # Il prefetch gira in un altro thread: lo scheduler e la coda dei prefetch vanno letti insieme
+        with self.prefetch_lock:
+            state = {
+                'selected_categories': self.selected_categories,
+                'quiz_direction': self.quiz_direction,
+                'correct_answers': self.correct_answers,
+                'total_questions': self.total_questions,
+                'mistake_seq': self.mistake_seq,
+                'wrong_answers': [{'seq': mistake.seq, 'quiz': mistake.quiz.fields(), 'direction': mistake.direction,
+                                   'given_answer': mistake.given_answer} for mistake in self.wrong_answers],
+                'review': self.review_queue is not None,
+            }
+            if progress:
+                state['progress'] = self.scheduler.state([(category, quiz_index) for category, quiz_index, _ in self.prefetched])
+            return state
+
+    @invalidates_prefetch
+    def restore_session(self, state):
+        self.quiz_direction = state['quiz_direction']
+        self.correct_answers = state['correct_answers']
+        self.total_questions = state['total_questions']
+        self.mistake_seq = state['mistake_seq']
+        # Gli errori salvati nel formato precedente, solo testo, non vengono ripresi
+        self.wrong_answers = deque((Mistake(error['seq'], QuizItem(*error['quiz']), error['direction'], error['given_answer'])
+                                    for error in state['wrong_answers'] if 'quiz' in error), maxlen=RECENT_MISTAKES)
+        self.scheduler.restore(state.get('progress', {}), state.get('shown', ()))
+        # Le categorie rinominate o cancellate nel frattempo non vengono riselezionate
+        self.select_categories([category for category in state['selected_categories'] if category in self.quiz_data])
+        if state['review']:
+            self.enable_review()
+
+    def save_session(self):
+        """Salva lo stato della sessione; il progresso completo solo se è cambiato in modo diverso da un quiz
+        mostrato, altrimenti solo i quiz mostrati dall'ultimo salvataggio."""
+        if self.user_id is None:
+            return
+        with self.prefetch_lock:
+            shown = self.scheduler.take_served()
+            state = self.session_state(progress=shown is None)
+        save_session_state(self.user_id, state, shown or ())
+
+    def resume_session(self):
+        """Ripristina l'ultima sessione salvata dell'utente; False se non ce n'è una utilizzabile."""
+        state = load_session_state(self.user_id)
+        if not state or not state['selected_categories']:
+            return False
+        self.restore_session(state)
+        return bool(self.selected_categories)
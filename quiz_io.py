@@ -0,0 +1,278 @@
+"""Kanji Quiz import/export
+
+Importazione ed esportazione in blocco dei quiz, in streaming: le righe vengono lette, validate e
+deduplicate una alla volta e i file dei dati vengono riscritti una sola volta alla fine.
+Formati: CSV/TSV, esportazioni di Anki in testo semplice, JMdict e KANJIDIC2 (XML).
+
+    python quiz_io.py import deck.csv --category "Vocabolario"
+    python quiz_io.py import JMdict_e.xml --category JMdict --lang en
+    python quiz_io.py export quiz.tsv
+"""
+import argparse
+import csv
+import html
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+
+from kana import kana_to_romaji
+from quiz_engine import commit_bulk, get_quiz_dataset
+
+
+FORMATS = ['csv', 'tsv', 'anki', 'jmdict', 'kanjidic']
+EXPORT_HEADERS = ['Kanji', 'Romaji', 'Significato', 'Categoria', 'Tipo']
+HEADER_FIELDS = {'kanji': 'kanji', 'romaji': 'romaji', 'romanji': 'romaji', 'significato': 'meaning',
+                 'meaning': 'meaning', 'categoria': 'category', 'category': 'category', 'tipo': 'type', 'type': 'type'}
+TYPE_ALIASES = {'a': 'a', 'v': 'v', 'aggettivo': 'a', 'adjective': 'a', 'adj': 'a', 'verbo': 'v', 'verb': 'v'}
+ANKI_SEPARATORS = {'tab': '\t', 'comma': ',', 'semicolon': ';', 'pipe': '|', 'space': ' '}
+ANKI_FIELDS = "kanji,meaning,romaji"  # ordine predefinito dei campi nelle note Anki
+JMDICT_LANGUAGES = {'en': 'eng', 'de': 'ger', 'fr': 'fre', 'es': 'spa', 'ru': 'rus', 'nl': 'dut',
+                    'sv': 'swe', 'hu': 'hun', 'sl': 'slv', 'pt': 'por'}
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+MAX_MEANINGS = 3  # significati tenuti per voce dei dizionari XML
+MAX_REPORTED_ERRORS = 20
+
+
+class ImportReport:
+    def __init__(self):
+        self.read = 0
+        self.added = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, where, reason):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"{where}: {reason}")
+
+    def summary(self):
+        return (f"Righe lette: {self.read}, quiz aggiunti: {self.added}, doppioni: {self.duplicates}, "
+                f"righe scartate: {self.rejected}")
+
+
+def clean(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.xml':
+        with open(path, "rb") as f:
+            head = f.read(1 << 16)
+        return 'kanjidic' if b'<kanjidic2' in head else 'jmdict'
+    if extension in ('.tsv', '.tab'):
+        return 'tsv'
+    if extension == '.txt':
+        return 'anki'
+    return 'csv'
+
+
+def read_csv(path, delimiter):
+    """(posizione, campi) per ogni riga; la prima riga è un'intestazione se contiene nomi di colonna noti,
+    altrimenti le colonne sono nell'ordine del file Excel."""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        if delimiter is None:
+            sample = f.read(1 << 12)
+            f.seek(0)
+            try:
+                delimiter = csv.Sniffer().sniff(sample, delimiters=",;\t").delimiter
+            except csv.Error:
+                delimiter = ','
+        rows = csv.reader(f, delimiter=delimiter)
+        columns = ['kanji', 'romaji', 'meaning', 'category', 'type']
+        for line, row in enumerate(rows, start=1):
+            if line == 1:
+                names = [HEADER_FIELDS.get((cell.strip().lower().split() or [''])[0]) for cell in row]
+                if any(names):
+                    columns = names
+                    continue
+            yield f"riga {line}", {field: value for field, value in zip(columns, row) if field}
+
+
+def read_anki(path, fields=ANKI_FIELDS):
+    """Note esportate da Anki come testo semplice, con le intestazioni '#chiave:valore' delle versioni recenti."""
+    fields = [field.strip() for field in fields.split(',')]
+    options = {}
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        line = 0
+        for raw in f:
+            line += 1
+            if raw.startswith('#'):
+                key, _, value = raw[1:].rstrip('\r\n').partition(':')
+                options[key.strip()] = value.strip()
+                continue
+            separator = ANKI_SEPARATORS.get(options.get('separator', 'tab'), options.get('separator', '\t'))
+            cells = next(csv.reader([raw.rstrip('\r\n')], delimiter=separator))
+            special = {}
+            for name in ('tags', 'deck', 'notetype', 'guid'):
+                column = options.get(f"{name} column")
+                if column and column.isdigit() and int(column) <= len(cells):
+                    special[name] = cells[int(column) - 1]
+            special_columns = {int(options[f"{name} column"]) - 1 for name in special}
+            values = [cell for index, cell in enumerate(cells) if index not in special_columns]
+            if options.get('html', 'false') == 'true':
+                values = [html.unescape(re.sub(r'<[^>]+>', ' ', value)) for value in values]
+            record = {field: value for field, value in zip(fields, values) if field}
+            if special.get('deck'):
+                # Il percorso completo serve a --map-category ("Giapponese::Verbi=Verbi")
+                record['deck'] = special['deck']
+                record['category'] = special['deck'].split('::')[-1]
+            for tag in special.get('tags', '').split():
+                if tag.startswith('tipo_'):
+                    record['type'] = tag[len('tipo_'):]
+            yield f"riga {line}", record
+
+
+def iter_elements(path, tag):
+    """Elementi `tag` di un file XML letti in streaming; ogni elemento viene liberato dopo l'uso."""
+    events = ElementTree.iterparse(path, events=('start', 'end'))
+    _, root = next(events)
+    for event, element in events:
+        if event == 'end' and element.tag == tag:
+            yield element
+            root.clear()
+
+
+def read_jmdict(path, lang='en'):
+    lang = JMDICT_LANGUAGES.get(lang, lang)
+    for position, entry in enumerate(iter_elements(path, 'entry'), start=1):
+        kanji = [keb.text for keb in entry.iter('keb')]
+        readings = [reb.text for reb in entry.iter('reb')]
+        meanings, quiz_type = [], None
+        for sense in entry.iter('sense'):
+            for pos in sense.iter('pos'):
+                if quiz_type is None and pos.text:
+                    text = pos.text.lower()
+                    quiz_type = 'v' if 'verb' in text and 'adverb' not in text else 'a' if 'adjective' in text else ''
+            meanings.extend(gloss.text for gloss in sense.iter('gloss') if gloss.get(XML_LANG, 'eng') == lang)
+            if meanings:
+                break  # Solo il primo senso con traduzioni nella lingua richiesta
+        yield f"voce {position}", {
+            'kanji': kanji[0] if kanji else None,
+            'romaji': kana_to_romaji(readings[0]).upper() if readings else None,
+            'meaning': "; ".join(meanings[:MAX_MEANINGS]),
+            'category': 'JMdict',
+            'type': quiz_type or None,
+        }
+
+
+def read_kanjidic(path, lang='en'):
+    for position, character in enumerate(iter_elements(path, 'character'), start=1):
+        on = [kana_to_romaji(r.text) for r in character.iter('reading') if r.get('r_type') == 'ja_on']
+        kun = [kana_to_romaji(r.text.replace('.', '')) for r in character.iter('reading') if r.get('r_type') == 'ja_kun']
+        meanings = [m.text for m in character.iter('meaning') if m.get('m_lang', 'en') == lang]
+        grade = character.findtext('misc/grade')
+        # Stesso formato delle letture già presenti nel mazzo: "ON:(ichi/itsu) KUN:(hito-/hitotsu)"
+        romaji = " ".join(f"{label}:({'/'.join(readings)})" for label, readings in (('ON', on), ('KUN', kun)) if readings)
+        yield f"carattere {position}", {
+            'kanji': character.findtext('literal'),
+            'romaji': romaji,
+            'meaning': ", ".join(meanings[:MAX_MEANINGS]),
+            'category': f"KANJIDIC grado {grade}" if grade else 'KANJIDIC',
+            'type': None,
+        }
+
+
+def read_records(path, fmt, lang='en', fields=ANKI_FIELDS):
+    if fmt == 'csv':
+        return read_csv(path, None)
+    if fmt == 'tsv':
+        return read_csv(path, '\t')
+    if fmt == 'anki':
+        return read_anki(path, fields)
+    if fmt == 'jmdict':
+        return read_jmdict(path, lang)
+    if fmt == 'kanjidic':
+        return read_kanjidic(path, lang)
+    raise ValueError(f"Formato sconosciuto: {fmt}")
+
+
+def validate(records, report, category=None, category_map=None):
+    """Normalizza e controlla le righe lette; quelle non valide vengono contate nel report e saltate.
+    `category` sostituisce quella indicata nel file, `category_map` rinomina le categorie lette (per le note
+    Anki vale prima il percorso completo del mazzo, poi il suo ultimo componente)."""
+    category_map = category_map or {}
+    for where, record in records:
+        report.read += 1
+        quiz = {field: clean(record.get(field)) for field in ('kanji', 'romaji', 'meaning', 'category', 'type')}
+        if not quiz['romaji'] or not quiz['meaning']:
+            report.reject(where, "romaji e significato sono obbligatori")
+            continue
+        if quiz['type']:
+            quiz_type = TYPE_ALIASES.get(quiz['type'].lower())
+            if quiz_type is None:
+                report.reject(where, f"tipo non valido: {quiz['type']}")
+                continue
+            quiz['type'] = quiz_type
+        mapped = category_map.get(clean(record.get('deck')), category_map.get(quiz['category'], quiz['category']))
+        quiz['category'] = category or mapped or "Generale"
+        yield quiz
+
+
+def import_file(path, fmt=None, category=None, category_map=None, lang='en', fields=ANKI_FIELDS):
+    """Importa un file nel mazzo con un solo salvataggio finale e restituisce un ImportReport."""
+    report = ImportReport()
+    records = read_records(path, fmt or detect_format(path), lang, fields)
+    report.added, report.duplicates = commit_bulk(validate(records, report, category, category_map))
+    return report
+
+
+def export_file(path, fmt=None):
+    """Scrive il mazzo corrente riga per riga, in un formato che import_file sa rileggere."""
+    fmt = fmt or detect_format(path)
+    quiz_data = get_quiz_dataset().quiz_data
+    count = 0
+    with open(path, "w", newline='', encoding='utf-8') as f:
+        if fmt == 'anki':
+            f.write("#separator:tab\n#html:false\n#deck column:4\n#tags column:5\n")
+            writer = csv.writer(f, delimiter='\t')
+            for category, quizzes in quiz_data.items():
+                for quiz in quizzes:
+                    writer.writerow([quiz['kanji'] or '', quiz['meaning'] or '', quiz['romaji'] or '', category,
+                                     f"tipo_{quiz['type']}" if quiz['type'] else ''])
+                    count += 1
+        elif fmt in ('csv', 'tsv'):
+            writer = csv.writer(f, delimiter='\t' if fmt == 'tsv' else ',')
+            writer.writerow(EXPORT_HEADERS)
+            for category, quizzes in quiz_data.items():
+                for quiz in quizzes:
+                    writer.writerow([quiz['kanji'], quiz['romaji'], quiz['meaning'], category, quiz['type']])
+                    count += 1
+        else:
+            raise ValueError(f"Esportazione non disponibile nel formato {fmt}")
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importazione ed esportazione dei quiz di Kanji Quiz")
+    commands = parser.add_subparsers(dest='command', required=True)
+    importer = commands.add_parser('import', help="aggiunge al mazzo i quiz di un file")
+    importer.add_argument('path')
+    importer.add_argument('--format', choices=FORMATS, help="dedotto dall'estensione se non indicato")
+    importer.add_argument('--category', help="categoria per tutti i quiz importati")
+    importer.add_argument('--map-category', action='append', default=[], metavar='VECCHIA=NUOVA',
+                          help="rinomina una categoria letta dal file; per Anki anche il percorso del mazzo, "
+                               "es. 'Giapponese::Verbi=Verbi' (ripetibile)")
+    importer.add_argument('--lang', default='en', help="lingua dei significati per JMdict/KANJIDIC")
+    importer.add_argument('--fields', default=ANKI_FIELDS, help="ordine dei campi nelle note Anki")
+    exporter = commands.add_parser('export', help="scrive il mazzo corrente in un file")
+    exporter.add_argument('path')
+    exporter.add_argument('--format', choices=['csv', 'tsv', 'anki'])
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        category_map = dict(mapping.split('=', 1) for mapping in args.map_category)
+        report = import_file(args.path, args.format, args.category, category_map, args.lang, args.fields)
+        print(report.summary())
+        for error in report.errors:
+            print(f"  {error}")
+    else:
+        print(f"Quiz esportati: {export_file(args.path, args.format)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Kanji Quiz search
+
+Indice di ricerca per categoria su kanji, romaji e significato, usato dall'editor dei quiz.
+Testi e ricerche passano dalla stessa normalizzazione (kana -> romaji, maiuscole, accenti e macron,
+apostrofi), così "たべる", "TABERU" e "taberu" trovano lo stesso quiz. Le vocali lunghe si riducono solo nei
+campi kanji e romaji e nelle parole della ricerca che sembrano romaji, così "tōkyō" trova "toukyou" ma il
+significato "coordinare" resta com'è.
+"""
+import bisect
+import re
+import unicodedata
+
+from kana import kana_to_romaji
+
+
+SEARCH_FIELDS = ('kanji', 'romaji', 'meaning')
+FOLDED_FIELDS = ('kanji', 'romaji')  # campi in cui si riducono le vocali lunghe
+WORD = re.compile(r"\w+")
+LONG_VOWEL = re.compile(r"ou|([aeiou])\1")
+# Parola fatta solo di sillabe Hepburn (o Kunrei), con le consonanti doppie di っ
+ROMAJI_WORD = re.compile(r"(?:(?:[kgnhbpmr]y|sh|ch|ts|[kgsztdnhbpmrfjvyw])?[aeiou]|n|([kgsztdhbpmfcj])(?=\1)|t(?=ch))+")
+
+_indexes = {}  # categoria -> (lista dei quiz indicizzata, indice)
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKC', str(text or '')).casefold()
+    # Dopo la traslitterazione restano da togliere solo accenti e macron delle lettere latine
+    text = unicodedata.normalize('NFKD', kana_to_romaji(text))
+    return "".join(char for char in text if not unicodedata.combining(char)).replace("'", "")
+
+
+def fold_long_vowels(text):
+    return LONG_VOWEL.sub(lambda match: match.group(1) or 'o', text)
+
+
+def fold_romaji_words(text):
+    return WORD.sub(lambda match: fold_long_vowels(match.group()) if ROMAJI_WORD.fullmatch(match.group())
+                    else match.group(), text)
+
+
+def quiz_text(quiz):
+    return "\x1f".join(fold_long_vowels(normalize(quiz[field])) if field in FOLDED_FIELDS else normalize(quiz[field])
+                        for field in SEARCH_FIELDS)
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    """Indice di una categoria: termini ordinati per la ricerca per prefisso (bisect) e trigrammi per quella
+    per sottostringa. Gli id dei quiz sono le posizioni nella categoria, stabili tra versioni dei dati perché
+    i quiz vengono aggiunti in coda e modificati sul posto, mai rimossi o riordinati."""
+
+    def __init__(self, quizzes):
+        self.quizzes = quizzes
+        self.texts = [quiz_text(quiz) for quiz in quizzes]
+        self.exact = {}
+        self.trigrams = {}
+        terms = []
+        for quiz_id, text in enumerate(self.texts):
+            for key in set(text.split("\x1f")):
+                self.exact.setdefault(key, []).append(quiz_id)
+            for gram in trigrams(text):
+                self.trigrams.setdefault(gram, []).append(quiz_id)
+            terms.extend((term, quiz_id) for term in set(WORD.findall(text)))
+        terms.sort()
+        self.terms = terms
+
+    def derive(self, quizzes):
+        """Indice per una versione successiva della categoria: i quiz non toccati sono gli stessi oggetti,
+        quindi si reindicizzano solo quelli modificati o aggiunti, copiando solo le liste coinvolte."""
+        old = self.quizzes
+        changed = [quiz_id for quiz_id, quiz in enumerate(quizzes) if quiz_id >= len(old) or old[quiz_id] is not quiz]
+        if len(quizzes) < len(old) or len(changed) > len(quizzes) // 8:
+            return SearchIndex(quizzes)
+        index = SearchIndex([])
+        index.quizzes = quizzes
+        index.texts = list(self.texts)
+        index.exact = dict(self.exact)
+        index.trigrams = dict(self.trigrams)
+        index.terms = list(self.terms)
+        for quiz_id in changed:
+            if quiz_id < len(old):
+                index._update(quiz_id, index.texts[quiz_id], remove=True)
+                index.texts[quiz_id] = quiz_text(quizzes[quiz_id])
+            else:
+                index.texts.append(quiz_text(quizzes[quiz_id]))
+            index._update(quiz_id, index.texts[quiz_id])
+        return index
+
+    def _update(self, quiz_id, text, remove=False):
+        for buckets, keys in ((self.exact, set(text.split("\x1f"))), (self.trigrams, trigrams(text))):
+            for key in keys:
+                ids = [other for other in buckets.get(key, []) if other != quiz_id]
+                if not remove:
+                    ids.append(quiz_id)
+                if ids:
+                    buckets[key] = ids
+                else:
+                    del buckets[key]
+        for term in set(WORD.findall(text)):
+            if remove:
+                del self.terms[bisect.bisect_left(self.terms, (term, quiz_id))]
+            else:
+                bisect.insort(self.terms, (term, quiz_id))
+
+    def prefix_ids(self, word):
+        ids = set()
+        for term, quiz_id in self.terms[bisect.bisect_left(self.terms, (word,)):]:
+            if not term.startswith(word):
+                break
+            ids.add(quiz_id)
+        return ids
+
+    def substring_ids(self, word):
+        if len(word) < 3:
+            return {quiz_id for quiz_id, text in enumerate(self.texts) if word in text}
+        postings = sorted((self.trigrams.get(word[i:i + 3], ()) for i in range(len(word) - 2)), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return {quiz_id for quiz_id in candidates if word in self.texts[quiz_id]}
+
+    def search(self, query):
+        """Id dei quiz che contengono tutte le parole della ricerca: prima quelli con un campo uguale
+        alla ricerca, poi quelli in cui ogni parola è l'inizio di un termine, poi le altre corrispondenze.
+        Una ricerca vuota restituisce tutta la categoria."""
+        query = fold_romaji_words(normalize(query)).strip()
+        words = WORD.findall(query)
+        if not words:
+            return list(range(len(self.texts)))
+        matches = set.intersection(*(self.substring_ids(word) for word in words))
+        prefixed = set.intersection(*(self.prefix_ids(word) for word in words))
+        exact = set(self.exact.get(query, ()))
+        return sorted(matches, key=lambda quiz_id: (quiz_id not in exact, quiz_id not in prefixed, quiz_id))
+
+
+def category_index(quiz_data, category):
+    """Indice della categoria nella versione dei dati indicata, ricostruito solo quando la sua lista cambia."""
+    quizzes = quiz_data[category]
+    cached = _indexes.get(category)
+    if cached is not None and cached[0] is quizzes:
+        return cached[1]
+    index = cached[1].derive(quizzes) if cached is not None else SearchIndex(quizzes)
+    _indexes[category] = (quizzes, index)
+    return index
+
+
+def search_quizzes(quiz_data, category, query, page=0, page_size=50):
+    """Una pagina di risultati come lista di (id, quiz), insieme al numero totale di risultati."""
+    ids = category_index(quiz_data, category).search(query)
+    return [(quiz_id, quiz_data[category][quiz_id]) for quiz_id in ids[page * page_size:(page + 1) * page_size]], len(ids)
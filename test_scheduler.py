@@ -0,0 +1,241 @@
+"""Test di DeckProgress e QuizScheduler (nessuna ripetizione, estrazioni uniformi) e dell'ordine di ReviewQueue."""
+import json
+import random
+import unittest
+from unittest import mock
+
+from quiz_engine import DAY, REVIEW_RELEARN_DELAY, DeckProgress, QuizItem, QuizScheduler, ReviewQueue
+
+
+def draw_all(deck):
+    return [deck.draw() for _ in range(deck.remaining)]
+
+
+def make_quiz_data(sizes):
+    return {category: [None] * size for category, size in sizes.items()}
+
+
+class DeckProgressTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(1234)
+
+    def test_draws_every_index_once(self):
+        for size in (1, 2, 15, 16, 17, 100, 1000):
+            deck = DeckProgress(size)
+            self.assertEqual(sorted(draw_all(deck)), list(range(size)))
+            self.assertEqual(deck.remaining, 0)
+
+    def test_switches_to_array_past_one_sixteenth(self):
+        deck = DeckProgress(160)
+        drawn = [deck.draw() for _ in range(5)]
+        self.assertIsNone(deck.order)
+        drawn += [deck.draw() for _ in range(10)]
+        self.assertIsNotNone(deck.order)
+        self.assertEqual(deck.swaps, {})
+        drawn += draw_all(deck)
+        self.assertEqual(sorted(drawn), list(range(160)))
+
+    def test_undraw_puts_index_back(self):
+        for size in (20, 400):  # con il dizionario degli scambi e dopo il passaggio all'array
+            deck = DeckProgress(size)
+            shown = []
+            while deck.remaining:
+                quiz_index = deck.draw()
+                if random.random() < 0.3:
+                    deck.undraw(quiz_index)
+                else:
+                    shown.append(quiz_index)
+            self.assertEqual(sorted(shown), list(range(size)))
+
+    def test_resize_adds_new_indices_as_unseen(self):
+        for drawn_before in (3, 60):  # prima e dopo il passaggio all'array
+            deck = DeckProgress(100)
+            shown = [deck.draw() for _ in range(drawn_before)]
+            deck.resize(130)
+            self.assertEqual(deck.remaining, 130 - drawn_before)
+            shown += draw_all(deck)
+            self.assertEqual(sorted(shown), list(range(130)))
+
+    def test_shrinking_resets_progress(self):
+        deck = DeckProgress(50)
+        for _ in range(20):
+            deck.draw()
+        deck.resize(40)
+        self.assertEqual(sorted(draw_all(deck)), list(range(40)))
+
+    def test_copy_is_independent(self):
+        deck = DeckProgress(300)
+        for _ in range(100):
+            deck.draw()
+        copy = deck.copy()
+        unseen = sorted(draw_all(copy))
+        self.assertEqual(deck.remaining, 200)
+        self.assertEqual(sorted(draw_all(deck)), unseen)
+
+    def test_first_draw_is_uniform(self):
+        size, trials = 8, 16000
+        counts = [0] * size
+        for _ in range(trials):
+            counts[DeckProgress(size).draw()] += 1
+        expected = trials / size
+        chi_square = sum((count - expected) ** 2 / expected for count in counts)
+        self.assertLess(chi_square, 24.3)  # 7 gradi di libertà, p = 0.001
+
+    def test_every_position_is_uniform(self):
+        # Anche dopo alcune estrazioni ogni quiz rimasto ha la stessa probabilità di uscire
+        size, trials = 6, 12000
+        counts = [[0] * size for _ in range(size)]
+        for _ in range(trials):
+            for position, quiz_index in enumerate(draw_all(DeckProgress(size))):
+                counts[position][quiz_index] += 1
+        expected = trials / size
+        for row in counts:
+            self.assertLess(sum((count - expected) ** 2 / expected for count in row), 20.5)  # 5 gradi di libertà, p = 0.001
+
+
+class QuizSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(5678)
+        self.quiz_data = make_quiz_data({'a': 30, 'b': 500, 'c': 7})
+
+    def draw_all(self, scheduler):
+        return [scheduler.draw() for _ in range(scheduler.remaining)]
+
+    def test_no_repeats_across_categories(self):
+        scheduler = QuizScheduler()
+        scheduler.select(['a', 'b', 'c'], self.quiz_data)
+        drawn = self.draw_all(scheduler)
+        self.assertEqual(len(drawn), len(set(drawn)))
+        self.assertEqual(set(drawn), {(category, i) for category, quizzes in self.quiz_data.items()
+                                      for i in range(len(quizzes))})
+        self.assertIsNone(scheduler.draw())
+        self.assertEqual(scheduler.shown(), (537, 537))
+
+    def test_progress_survives_selection_changes(self):
+        scheduler = QuizScheduler()
+        scheduler.select(['a'], self.quiz_data)
+        drawn = [scheduler.draw() for _ in range(10)]
+        scheduler.select(['c'], self.quiz_data)
+        drawn += self.draw_all(scheduler)
+        scheduler.select(['a', 'c'], self.quiz_data)
+        self.assertEqual(scheduler.remaining, 20)
+        drawn += self.draw_all(scheduler)
+        self.assertEqual(sorted(drawn), sorted(('a', i) for i in range(30)) + sorted(('c', i) for i in range(7)))
+
+    def test_undraw_and_grown_category(self):
+        scheduler = QuizScheduler()
+        scheduler.select(['a', 'b'], self.quiz_data)
+        shown = []
+        for _ in range(200):
+            category, quiz_index = scheduler.draw()
+            if random.random() < 0.25:
+                scheduler.undraw(category, quiz_index)
+            else:
+                shown.append((category, quiz_index))
+        self.quiz_data['b'] = self.quiz_data['b'] + [None] * 40
+        scheduler.select(['a', 'b'], self.quiz_data)
+        shown += self.draw_all(scheduler)
+        self.assertEqual(sorted(shown), sorted([('a', i) for i in range(30)] + [('b', i) for i in range(540)]))
+
+    def test_state_round_trip(self):
+        for drawn_before in (4, 100, 400):  # con il dizionario degli scambi e dopo il passaggio all'array
+            scheduler = QuizScheduler()
+            scheduler.select(['a', 'b'], self.quiz_data)
+            shown = [scheduler.draw() for _ in range(drawn_before)]
+            pending = scheduler.draw()
+            state = json.loads(json.dumps(scheduler.state(undrawn=[pending])))
+
+            restored = QuizScheduler()
+            restored.restore(state)
+            restored.select(['a', 'b'], self.quiz_data)
+            self.assertEqual(restored.shown(), (drawn_before, 530))
+            shown += self.draw_all(restored)
+            self.assertEqual(sorted(shown), sorted([('a', i) for i in range(30)] + [('b', i) for i in range(500)]))
+
+    def test_served_quizzes_update_saved_state(self):
+        scheduler = QuizScheduler()
+        scheduler.select(['a', 'b'], self.quiz_data)
+        self.assertIsNone(scheduler.take_served())  # il primo salvataggio è completo
+        shown = [scheduler.draw() for _ in range(150)]
+        pending = scheduler.draw()
+        base = json.loads(json.dumps(scheduler.state(undrawn=[pending])))
+        self.assertEqual(scheduler.take_served(), [])
+        served = [pending] + [scheduler.draw() for _ in range(200)]
+        for quiz in served:
+            scheduler.serve(*quiz)
+        self.quiz_data['b'] = self.quiz_data['b'] + [None] * 10
+        scheduler.select(['a', 'b'], self.quiz_data)
+        served.append(scheduler.draw())
+        scheduler.serve(*served[-1])
+        self.assertEqual(scheduler.take_served(), served)
+
+        restored = QuizScheduler()
+        restored.restore(base, json.loads(json.dumps(served)))
+        restored.select(['a', 'b'], self.quiz_data)
+        self.assertEqual(restored.remaining, scheduler.remaining)
+        shown += [tuple(quiz) for quiz in served] + self.draw_all(restored)
+        self.assertEqual(sorted(shown), sorted([('a', i) for i in range(30)] + [('b', i) for i in range(510)]))
+
+    def test_reset_and_rename_need_full_state(self):
+        scheduler = QuizScheduler()
+        scheduler.select(['a'], self.quiz_data)
+        scheduler.take_served()
+        scheduler.reset()
+        self.assertIsNone(scheduler.take_served())
+        scheduler.rename('a', 'z')
+        self.assertIsNone(scheduler.take_served())
+
+    def test_state_does_not_change_progress(self):
+        scheduler = QuizScheduler()
+        scheduler.select(['b'], self.quiz_data)
+        pending = [scheduler.draw() for _ in range(3)]
+        scheduler.state(undrawn=pending)
+        self.assertEqual(scheduler.shown(), (3, 500))
+
+    def test_categories_weighted_by_remaining(self):
+        trials = 10000
+        counts = {'a': 0, 'c': 0}
+        quiz_data = make_quiz_data({'a': 3, 'c': 1})
+        for _ in range(trials):
+            scheduler = QuizScheduler()
+            scheduler.select(['a', 'c'], quiz_data)
+            counts[scheduler.draw()[0]] += 1
+        self.assertAlmostEqual(counts['a'] / trials, 0.75, delta=0.02)
+
+
+class ReviewQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1_000_000.0
+        for patch in (mock.patch('quiz_engine.time.time', lambda: self.now), mock.patch('quiz_engine.save_review_state')):
+            patch.start()
+            self.addCleanup(patch.stop)
+        quiz_data = {'a': [QuizItem(str(i), f"romaji{i}", f"significato{i}", 'a', None) for i in range(80)]}
+        self.queue = ReviewQueue('test')
+        self.queue.states = {}  # nessuno stato salvato: non legge il database
+        self.queue.select(['a'], quiz_data)
+
+    def answer(self, correct):
+        quiz = self.queue.draw()
+        self.queue.answer(correct)
+        return quiz
+
+    def test_missed_quiz_comes_back_before_new_ones(self):
+        missed = self.answer(False)
+        for _ in range(5):
+            self.answer(True)
+        self.now += REVIEW_RELEARN_DELAY - 1
+        self.assertNotEqual(self.answer(True), missed)  # non ancora scaduto: un quiz nuovo
+        self.now += 1
+        self.assertEqual(self.queue.draw(), missed)
+
+    def test_nothing_before_the_next_due_review(self):
+        seen = {self.answer(True) for _ in range(80)}
+        self.assertEqual(len(seen), 80)
+        self.assertIsNone(self.queue.draw())
+        self.assertEqual(self.queue.next_due(), self.now + DAY)
+        self.now += DAY
+        self.assertIn(self.queue.draw(), seen)
+
+
+if __name__ == '__main__':
+    unittest.main()